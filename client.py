@@ -4,17 +4,45 @@ import ssl
 import os
 import shutil
 import re
-import stat
-from tempfile import gettempdir
-import zlib
-import gzip
 import uuid
-from datetime import datetime
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from logger import Logger
 from exceptions import *
 from file_structure import File_Structure
+from serializer import dump_json, load_json
+from framing import (CHUNKED, SKIP_FRAME, SKIP_SIGNAL, frame, make_reader,
+                        send_msg, recv_msg, recv_exact, set_socket_buffers)
+from compression import compress, zlib_decompressor
+from transfer import (RECV_CHUNK, compress_file, join_root, keep_compressed,
+                        make_directory, purge_directory, recv_buffers, recv_file,
+                        send_compressed, send_uncompressed)
 import time
 
+ssl_contexts = {}
+
+
+def load_ssl_context(cert):
+    """
+    Gets a client SSL context trusting a certificate. Contexts are cached per
+    certificate path and only rebuilt when the certificate modification time
+    changes, so repeated syncs do not re-read and re-parse it.
+
+    Args:
+        cert (str): Path to certificate file.
+
+    Returns:
+        SSLContext: Client SSL context.
+    """
+    last_mod = os.stat(cert).st_mtime_ns
+    cached = ssl_contexts.get(cert)
+    if cached is not None and cached[0] == last_mod:
+        return cached[1]
+    context = ssl.create_default_context()
+    context.load_verify_locations(cert)
+    ssl_contexts[cert] = (last_mod, context)
+    return context
+
 
 class Client:
     """
@@ -40,6 +68,7 @@ class Client:
         self.__configure()
         self.__logger = Logger(self.__conf['logging'], self.__conf_path, self.__hostname, self.__conf['logging_limit'])
         self.__dir_mods = []
+        self.__recv_pool = []
     
     def __configure(self):
         """
@@ -61,9 +90,12 @@ class Client:
         """
         Starts the sync process for the client.
         """
-        start_time = datetime.now()
+        start_time = time.perf_counter_ns()
+        self.__writer = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='File_Writer')
         try:
             self.__conn = self.__connect()
+            self.__reader = make_reader(self.__conn)
             self.__sync_config()
             self.__process()
         except socket.timeout:
@@ -75,15 +107,18 @@ class Client:
         finally:
             try:
                 self.__conn.shutdown(socket.SHUT_RDWR)
+                self.__reader.close()
                 self.__conn.close()
             except:
                 pass
+            self.__writer.shutdown()
             self.__logger.log('Connection with Server closed.', 2)
             if self.__conf['backup_limit'] is not None:
                 self.__purge_backups()
             self.__timeshift_dirs()
-            time_elapsed = datetime.now() - start_time
-            self.__logger.log(f'Time elapsed {time_elapsed}.', 2)
+            time_elapsed = (time.perf_counter_ns() - start_time) / 1e6
+            self.__logger.log(f'Time elapsed {time_elapsed:.1f} ms.', 2)
+            self.__logger.close()
 
     def __connect(self):
         """
@@ -94,9 +129,10 @@ class Client:
         """
         self.__logger.log('Connecting to Server...', 2)
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        set_socket_buffers(sock)
         if self.__conf['encryption']:
-            context = ssl.create_default_context()
-            context.load_verify_locations(self.__cert)
+            context = load_ssl_context(self.__cert)
             sock = context.wrap_socket(sock, server_hostname=self.__hostname)
         sock.connect((self.__hostname, self.__port))
         print(f'Connected to Server ({self.__hostname}, {self.__port})')
@@ -108,11 +144,10 @@ class Client:
         Syncs configuration with Server to most agreeable preferences
         """
         self.__logger.log('Syncing configuration...', 2)
-        conf_stream = json.dumps(self.__clean_config()).encode()
-        self.__conn.sendall(conf_stream)
-        data = self.__conn.recv(1024)
-        self.__conf.update(json.loads(data))
-        self.__conn.sendall(data)
+        conf_stream = dump_json(self.__clean_config())
+        send_msg(self.__conn, conf_stream)
+        data = recv_msg(self.__reader)
+        self.__conf.update(load_json(data))
         self.__logger.log('Sync configured.', 2)
 
     def __clean_config(self):
@@ -137,42 +172,47 @@ class Client:
         """
         data = b'OPEN'
         while data != b'BYE':
-            data = self.__conn.recv(1024)
+            data = recv_msg(self.__reader)
+            command, _, argument = data.partition(b' ')
             try:
                 if data == b'REQUEST STRUCT':
                     self.__send_struct()
-                elif data[0:7] == b'REQUEST':
-                    self.__send_file(data[8:].decode('UTF-8'))
-                elif data[0:5] == b'MKDIR':
-                    self.__get_directory(data[6:])
-                elif data[0:6] == b'MKFILE':
-                    self.__get_file(data[7:])
-                elif data[0:6] == b'DELETE':
-                    self.__delete_down(data[7:])
-                elif data[0:14] == b'CONFIRM DELETE':
-                    self.__confirm_delete(data[15:])
+                elif command == b'REQUEST':
+                    self.__send_file(argument.decode('UTF-8'))
+                elif command == b'BATCH':
+                    self.__get_batch(data)
+                elif command == b'MKFILE':
+                    self.__get_file(argument)
+                elif data.startswith(b'CONFIRM DELETES '):
+                    self.__confirm_deletes(data[16:])
                 elif data != b'BYE':
-                    self.__conn.sendall(b'RETRY')
+                    send_msg(self.__conn, b'RETRY')
             except SkipResponseException:
                 pass
 
     def __send_struct(self):
         """
-        Sends file structure to the server for comparrision.
+        Sends file structure to the server for comparrision. The structure
+        is skipped if the server already holds a copy with the same hash.
 
         Raises:
             MissSpeakException: Raised if file structure acknowledgment fails.
         """
         self.__logger.log('Sending struct...', 2)
-        struct_bytes = self.__struct.dump_structure().encode('UTF-8')
+        struct_bytes = self.__struct.dump_structure()
+        struct_hash = hashlib.blake2b(struct_bytes, digest_size=16).hexdigest()
+        compressed = 0
         if self.__conf['compression'] and len(struct_bytes) >= self.__conf['compression_min']:
-            struct_bytes = zlib.compress(struct_bytes, level=self.__conf['compression'])
-        struct_info = f'STRUCT {len(struct_bytes)}'
+            struct_bytes = compress(struct_bytes, self.__conf['compression'])
+            compressed = 1
+        struct_info = f'STRUCT {len(struct_bytes)} {struct_hash} {compressed}'
         b_struct_info = struct_info.encode('UTF-8')
-        self.__conn.sendall(b_struct_info)
-        data = self.__conn.recv(1024)
+        send_msg(self.__conn, b_struct_info)
+        data = recv_msg(self.__reader)
         msg = data.decode('UTF-8')
-        if msg == f'OK {struct_info}':
+        if msg == 'OK CACHED':
+            self.__logger.log('Struct unchanged on server.', 2)
+        elif msg == f'OK {struct_info}':
             self.__conn.sendall(struct_bytes)
             self.__logger.log('Struct sent.', 2)
         else:
@@ -181,262 +221,234 @@ class Client:
 
     def __send_file(self, path):
         """
-        Sends file to remote server.
+        Sends file to remote server. The file information is followed
+        directly by its data without waiting for an acknowledgment.
 
         Args:
             path (str): Local path of file to send.
 
         Raises:
-            MissSpeakException: Raises if remote server does not correctly
-            acknowledge amount of bytes to be sent.
+            SkipResponseException: Raised if the file could not be read.
+            MissSpeakException: Raised if an uncompressed file fails after
+            its size was announced, which cannot be signalled in band.
         """
-        abs_path = path.replace('.', self.__root, 1)
-        info = self.__struct.get_structure()[abs_path]
+        abs_path = join_root(self.__root, path)
+        info = self.__struct.get_structure()[path].to_dict()
         info['path'] = path
-        byte_total = os.path.getsize(abs_path)
-        compressed = False
-        if self.__conf['compression'] and byte_total >= self.__conf['compression_min']:
+        byte_total = info['size']
+        compressed = self.__conf['compression'] and byte_total >= self.__conf['compression_min']
+        payload = None
+        if compressed and keep_compressed(byte_total, self.__conf):
+            self.__logger.log(f'Compressing {path}...', 4)
             try:
-                byte_total, abs_path = self.__compress(abs_path)
-                compressed = True
-            except PermissionError:
-                self.__conn.sendall(b'!!SKIP!!SKIP!!')
-                raise SkipResponseException()
+                payload = compress_file(abs_path, self.__conf)
+            except (PermissionError, FileNotFoundError):
+                self.__logger.log('Error encountered reading file ' + path, 1)
+                send_msg(self.__conn, SKIP_SIGNAL)
+                raise SkipResponseException('REQUEST File')
+            byte_total = len(payload)
+        elif compressed:
+            byte_total = CHUNKED
         info['bytes'] = byte_total
-        info_stream = json.dumps(info).encode()
-        self.__conn.sendall(info_stream)
-
-        data = self.__conn.recv(1024)
-        if data == f'OK {byte_total}'.encode():
-            if byte_total > 0:
-                bytes_read = 0
-                self.__logger.log(f'Sending file {path} {byte_total}...', 4)
-                try:
-                    with open(abs_path, 'rb') as f:
-                        byte_chunk = min(self.__conf['ram'], byte_total)
-                        while bytes_read < byte_total:
-                            if byte_chunk != -1:
-                                file_bytes = f.read(byte_chunk)
-                            else:
-                                file_bytes = f.read()
-                            self.__conn.sendall(file_bytes)
-                            bytes_read += byte_chunk
-                except PermissionError:
-                    self.__conn.sendall(b'!!SKIP!!SKIP!!')
-                    self.__logger.log('Permssion error encountered reading file'
-                                        , 1)
-                    raise SkipResponseException('REQUEST File')
+        info_stream = dump_json(info)
+        if payload is not None:
+            self.__logger.log(f'Sending file {path} {byte_total}...', 4)
+            self.__conn.sendall(frame(info_stream) + payload)
+            return
+        if byte_total == 0:
+            send_msg(self.__conn, info_stream)
+            return
+        self.__logger.log(f'Sending file {path} {byte_total}...', 4)
+        header_sent = False
+        try:
+            with open(abs_path, 'rb') as f:
+                send_msg(self.__conn, info_stream)
+                header_sent = True
                 if compressed:
-                    try:
-                        os.remove(abs_path)
-                    except PermissionError:
-                        self.__logger.log('Permssion error encountered deleting'
-                                            + ' compressed file', 1)
+                    send_compressed(self.__conn, self.__writer, f, self.__conf)
+                else:
+                    if send_uncompressed(self.__conn, f, 0, byte_total):
+                        self.__logger.log(f'File {path} changed while sending data. '
+                                            + 'Sent zero padded.', 1)
+        except (PermissionError, FileNotFoundError):
+            self.__logger.log('Error encountered reading file ' + path, 1)
+            if not header_sent:
+                send_msg(self.__conn, SKIP_SIGNAL)
+            elif not compressed:
+                raise MissSpeakException('SEND File')
+            else:
+                self.__conn.sendall(SKIP_FRAME)
+            raise SkipResponseException('REQUEST File')
+
+    def __get_batch(self, msg):
+        """
+        Handles a batch of directory creation or deletion commands from remote
+        server.
+
+        Args:
+            msg (bytes): Batch command message.
+
+        Raises:
+            MissSpeakException: Raised if the batch command is unknown.
+        """
+        _, command, byte_total, compressed = msg.decode('UTF-8').split(' ')
+        if command not in ('MKDIR', 'DELETE'):
+            self.__logger.log(f'Unknown batch command {command}', 1)
+            raise MissSpeakException('BATCH')
+        send_msg(self.__conn, b'OK ' + msg)
+        batch = load_json(self.__recv_bytes(int(byte_total), compressed == '1'))
+        if command == 'MKDIR':
+            created = set()
+            batch.sort(key=lambda item: item[0].count(os.sep))
+            for dir_path, last_mod in batch:
+                self.__get_directory(dir_path, last_mod, created)
         else:
-            self.__logger.log('File send error', 1)
-            raise MissSpeakException('REQUEST File')
+            for path in batch:
+                self.__delete_down(path)
+        send_msg(self.__conn, b'OK')
+
+    def __recv_bytes(self, byte_total, compressed=False):
+        """
+        Handles incoming bytes from remote server. Compressed bytes are
+        decompressed chunk by chunk as they arrive.
+
+        Args:
+            byte_total (int): Total number of bytes expected to be received.
+            compressed (bool, optional): Whether the bytes are zlib
+            compressed. Defaults to False.
 
-    def __get_directory(self, msg):
+        Raises:
+            MissSpeakException: Raised if the connection closes early.
+
+        Returns:
+            bytearray: Bytes received from remote server, decompressed.
         """
-        Creates directory specified by remote server.
+        if not compressed:
+            try:
+                return recv_exact(self.__reader, byte_total)
+            except MissSpeakException:
+                self.__logger.log('Connection closed while receiving bytes', 1)
+                raise
+        decompressor = zlib_decompressor()
+        view = memoryview(recv_buffers(self.__recv_pool, min(RECV_CHUNK, byte_total), 1)[0])
+        data = bytearray()
+        byte_count = 0
+        while byte_count < byte_total:
+            received = self.__reader.readinto1(
+                view[:min(len(view), byte_total - byte_count)])
+            if not received:
+                self.__logger.log('Connection closed while receiving bytes', 1)
+                raise MissSpeakException('RECV Closed')
+            byte_count += received
+            data += decompressor.decompress(view[:received])
+        data += decompressor.flush()
+        return data
+
+    def __get_directory(self, dir_path, last_mod, created):
+        """
+        Creates directory specified by remote server. Modification times are
+        applied once all files are written, by __timeshift_dirs.
 
         Args:
-            msg (bytes): Directory creation command message.
+            dir_path (str): Relative path of directory to create.
+            last_mod (int): Last modification time of the directory.
+            created (set): Absolute paths of directories already created in
+            this batch.
         """
-        msg = msg.decode('UTF-8')
-        msg_parts = msg.split(' ')
-        last_mod = int(msg_parts[-1])
-        dir_path = ' '.join(msg_parts[:-1])
-        abs_path = dir_path.replace('.', self.__root, 1)
+        last_mod = int(last_mod)
+        abs_path = join_root(self.__root, dir_path)
         try:
-            os.makedirs(abs_path, exist_ok=True)
-            os.utime(abs_path, (last_mod, last_mod))
+            make_directory(abs_path, created)
         except PermissionError:
             self.__logger.log('Permission error encountered creating directory '
                             + abs_path, 1)
         self.__dir_mods.append((abs_path, (last_mod, last_mod)))
-        ack = 'OK MKDIR ' + msg
-        self.__conn.sendall(ack.encode())
         self.__logger.log(f'Recieved directory {dir_path}', 4)
 
     def __get_file(self, msg):
         """
-        Downloads or creates file specified by remote server.
+        Downloads or creates file specified by remote server. File data
+        follows the command immediately, without an acknowledgement.
 
         Args:
             msg (bytes): File creation command message.
         """
-        info = json.loads(msg)
+        info = load_json(msg)
         path = info['path']
-        abs_path = path.replace('.', self.__root, 1)
-        ack = f"OK MKFILE {info['path']} {info['bytes']}"
-        self.__conn.sendall(ack.encode())
-
+        abs_path = join_root(self.__root, path)
         byte_total = int(info['bytes'])
         self.__logger.log(f'Receiving file {path} {byte_total}...', 4)
-        if byte_total > 0:
-            try:
-                if self.__conf['compression'] and byte_total >= self.__conf['compression_min']:
-                    self.__recv_compressed_file(abs_path, byte_total)
-                else:
-                    self.__recv_file(abs_path, byte_total)
-            except PermissionError:
-                self.__conn.sendall(b'!!SKIP!!SKIP!!')
-                self.__logger.log('Permssion error encountered receiving file', 
-                                    1)
-                raise SkipResponseException('Get file')
-        else:
-            try:
+        compressed = self.__conf['compression'] and info['size'] >= self.__conf['compression_min']
+        try:
+            if byte_total != 0:
+                recv_file(self.__reader, self.__writer, abs_path, byte_total,
+                            self.__conf, self.__recv_pool, compressed)
+            else:
                 open(abs_path, 'wb+').close()
-            except PermissionError:
-                raise SkipResponseException('Get file')
-        last_mod = int(info['last_mod'])
-        os.utime(abs_path, (last_mod, last_mod))
-        self.__conn.sendall(b'OK')
-
-    def __recv_file(self, abs_path, byte_total):
-        """
-        Handles file download from remote server.
-
-        Args:
-            abs_path (str): Absolute path to place downloaded file.
-            byte_total (int): Total number of bytes to download.
-        """
-        with open(abs_path, 'wb+') as file:
-            byte_count = 0
-            byte_chunk = min(self.__conf['ram'], byte_total)
-            skip_cache = b''
-            while byte_count < byte_total:
-                if byte_chunk != -1:
-                    data = self.__conn.recv(byte_chunk)
-                else:
-                    data = self.__conn.recv()
-                if b'!!SKIP!!SKIP!!' in skip_cache+data:
-                    raise SkipResponseException('Recv file')
-                file.write(data)
-                byte_count += len(data)
-                skip_cache = data[-14:]
-    
-    def __recv_compressed_file(self, abs_path, byte_total):
-        """
-        Handles compressed file download from remote server.
-
-        Args:
-            abs_path (str): Absolute path to place downloaded file.
-            byte_total (int): Total number of bytes to download.
-        """
-        file_name = f'{datetime.now().microsecond}_' + os.path.basename(os.path.normpath(abs_path)) + '.gz'
-        z_path = os.path.join(gettempdir(), file_name)
-        with open(z_path, 'wb+') as zip_file:
-            byte_count = 0
-            byte_chunk = min(self.__conf['ram'], byte_total)
-            skip_cache = b''
-            while byte_count < byte_total:
-                if byte_chunk != -1:
-                    data = self.__conn.recv(byte_chunk)
-                else:
-                    data = self.__conn.recv()
-                if b'!!SKIP!!SKIP!!' in skip_cache+data:
-                    raise SkipResponseException('Recv file')
-                zip_file.write(data)
-                byte_count += len(data)
-                skip_cache = data[-14:]
-        with gzip.open(z_path, 'rb+') as zip_file:
-            with open(abs_path, 'wb+') as file:
-                shutil.copyfileobj(zip_file, file)
+            last_mod = int(info['last_mod'])
+            os.utime(abs_path, (last_mod, last_mod))
+        except (socket.timeout, ConnectionError):
+            raise
+        except OSError:
+            send_msg(self.__conn, SKIP_SIGNAL)
+            self.__logger.log('Error encountered receiving file ' + path, 1)
+            raise SkipResponseException('Get file')
+        send_msg(self.__conn, b'OK')
 
-    def __delete_down(self, msg):
+    def __delete_down(self, path):
         """
-        Handles deletion command from remote server.
+        Handles deletion command from remote server. Paths are removed as
+        files first, so a directory check is only made if that fails.
 
         Args:
-            msg (bytes): Deletion command from remote server.
+            path (str): Relative path to delete.
         """
-        path = msg.decode('UTF-8')
-        abs_path = path.replace('.', self.__root, 1)
+        abs_path = join_root(self.__root, path)
         try:
             self.__logger.log(f'Deleting {path}...', 3)
             if not self.__conf['backup']:
-                if os.path.isdir(path):
-                    shutil.rmtree(abs_path)
-                else:
+                try:
                     os.remove(abs_path)
+                except (IsADirectoryError, PermissionError):
+                    if not os.path.isdir(abs_path):
+                        raise
+                    shutil.rmtree(abs_path)
             else:
-                backup_path = path.replace('.', self.__conf['backup_path'], 1)
+                backup_path = join_root(self.__conf['backup_path'], path)
                 shutil.move(abs_path, backup_path)
         except FileNotFoundError:
             pass
         except PermissionError:
             pass
-        self.__conn.sendall(b'OK')
 
-    def __confirm_delete(self, path):
+    def __confirm_deletes(self, msg):
         """
-        Confirms deletion of file for remote server.
+        Confirms deletion of a batch of paths for remote server.
 
         Args:
-            path (str): Path of file to confirm for deletion.
-        """
-        path = path.decode('UTF-8')
-        abs_path = path.replace('.', self.__root, 1)
-        if not os.path.exists(abs_path):
-            ack = f'OK {path}'.encode()
-            self.__conn.sendall(ack)
-            self.__logger.log(f'Delete {path} confirmed.', 3)
-        else:
-            deny = f'NO {path}'.encode()
-            self.__conn.sendall(deny)
-            self.__logger.log(f'Delete {path} denied.', 3)
+            msg (bytes): Json list of paths to confirm for deletion.
+        """
+        decisions = []
+        root = self.__root
+        exists = os.path.exists
+        for path in load_json(msg):
+            allowed = not exists(root + path[1:])
+            decisions.append(allowed)
+            if allowed:
+                self.__logger.log(f'Delete {path} confirmed.', 3)
+            else:
+                self.__logger.log(f'Delete {path} denied.', 3)
+        send_msg(self.__conn, dump_json(decisions))
 
     def __purge_backups(self):
         """
         Removes old backups.
         """
         self.__logger.log('Cleaning backups...', 2)
-        day_limit = self.__conf['backup_limit']
-        now_time = datetime.now()
-        for _, dirs, files in os.walk(self.__conf['backup_path'], topdown=True):
-            for _dir in dirs:
-                status = os.stat(_dir)
-                last_mod = datetime.fromtimestamp(status[stat.ST_MTIME])
-                delta = now_time - last_mod
-                if delta.days >= day_limit:
-                    try:
-                        shutil.rmtree(_dir)
-                    except IOError:
-                        continue
-            for file in files:
-                status = os.stat(file)
-                last_mod = datetime.fromtimestamp(status[stat.ST_MTIME])
-                delta = now_time - last_mod
-                if delta.days >= day_limit:
-                    try:
-                        os.remove(file)
-                    except IOError:
-                        continue
+        cutoff = time.time() - self.__conf['backup_limit'] * 86400
+        purge_directory(self.__conf['backup_path'], cutoff)
         self.__logger.log('Backups cleaned...', 2)
 
-    def __compress(self, path):
-        """
-        Compresses file for upload.
-
-        Args:
-            path (str): Path to file for compression
-
-        Returns:
-            tuple(int, str): Tuple containing size of compressed file and its
-            path.
-        """
-        self.__logger.log(f'Compressing {path}...', 4)
-        file_name = f'{datetime.now().microsecond}_' + os.path.basename(os.path.normpath(path)) + '.gz'
-        temp_path = os.path.join(gettempdir(), 'pysync')
-        os.makedirs(temp_path, exist_ok=True)
-        with open(path, 'rb') as f_in:
-            z_path = os.path.join(temp_path, file_name)
-            with gzip.open(z_path, 'wb') as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        return os.path.getsize(z_path), z_path
-    
     def __timeshift_dirs(self):
         """
         Sets directories to proper last modification time after files are
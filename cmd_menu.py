@@ -1,5 +1,5 @@
-import argparse
 import os
+import sys
 import json
 from server import server_start
 from client import client_start
@@ -12,6 +12,8 @@ def parse_args():
     Returns:
         Namespace: Namespace of arguments.
     """
+    import argparse
+
     description = 'Synchronizes files and directories between a client and a server.'
     parser = argparse.ArgumentParser(description=description)
     parser.add_argument('--config', type=str, default=None,
@@ -43,7 +45,9 @@ def parse_args():
     parser.add_argument('--backup_limit', type=int, default=None,
                         help='Length of time files are held in backup location. (days)')
     parser.add_argument('--ram', type=int, default=None,
-                        help='Maximum amount of RAM to use for Syncs. (Bytes)\n-1 for unlimited.')
+                        help='Maximum amount of RAM to use for Syncs. (Bytes)\n'\
+                        + 'Also caps the chunk size files are read and received in,'\
+                        + ' with a floor of 64KB.\n-1 for unlimited.')
     parser.add_argument('--compression', type=int, default=None,
                         help='Compression level to use on large files. Follows'\
                         + ' the zlib compression levels. 0 is no compression'\
@@ -61,6 +65,28 @@ def parse_args():
     return parser.parse_args()
 
 
+def quick_parse_args(argv):
+    """
+    Parses silent mode launches that only specify a configuration file without
+    building the full argparse parser.
+
+    Args:
+        argv (list): Command line arguments excluding the program name.
+
+    Returns:
+        dict: Configuration dictionary or None if the full parser is needed.
+    """
+    if len(argv) == 1 and argv[0].startswith('--config='):
+        path = argv[0][len('--config='):]
+    elif len(argv) == 2 and argv[0] == '--config':
+        path = argv[1]
+    else:
+        return None
+    if path == '' or path.startswith('-'):
+        return None
+    return {'config': path}
+
+
 def print_intro():
     """
     Welcome message
@@ -580,6 +606,8 @@ def main(conf=None):
         conf (dict, optional): Configuration dictionary. If left to default
         command line arguments will be parsed. Defaults to None.
     """
+    if conf is None:
+        conf = quick_parse_args(sys.argv[1:])
     if conf is None:
         conf = vars(parse_args())
 
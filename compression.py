@@ -0,0 +1,82 @@
+import zlib
+try:
+    from isal import isal_zlib
+except ImportError:
+    isal_zlib = None
+try:
+    import deflate
+except ImportError:
+    deflate = None
+
+GZIP_WBITS = 31
+
+
+def isal_level(level):
+    """
+    Maps a zlib compression level (1-9) onto ISA-L's levels (0-3).
+
+    Args:
+        level (int): Zlib compression level.
+
+    Returns:
+        int: ISA-L compression level.
+    """
+    return min(3, (level + 2) // 3)
+
+
+def compress(data, level):
+    """
+    Compresses bytes into a zlib stream, using ISA-L or libdeflate when
+    available.
+
+    Args:
+        data (bytes): Bytes to compress.
+        level (int): Zlib compression level.
+
+    Returns:
+        bytes: Compressed bytes.
+    """
+    if isal_zlib is not None:
+        return isal_zlib.compress(data, isal_level(level))
+    if deflate is not None:
+        return deflate.zlib_compress(data, level)
+    return zlib.compress(data, level)
+
+
+def zlib_decompressor():
+    """
+    Builds a streaming zlib decompressor, using ISA-L when available.
+
+    Returns:
+        Decompress: Decompressor object.
+    """
+    if isal_zlib is not None:
+        return isal_zlib.decompressobj()
+    return zlib.decompressobj()
+
+
+def gzip_compressor(level):
+    """
+    Builds a streaming gzip compressor, using ISA-L when available.
+
+    Args:
+        level (int): Zlib compression level.
+
+    Returns:
+        Compress: Compressor object.
+    """
+    if isal_zlib is not None:
+        return isal_zlib.compressobj(isal_level(level), isal_zlib.DEFLATED, GZIP_WBITS)
+    return zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+
+
+def gzip_decompressor():
+    """
+    Builds a streaming gzip decompressor, using ISA-L when available.
+
+    Returns:
+        Decompress: Decompressor object.
+    """
+    if isal_zlib is not None:
+        return isal_zlib.decompressobj(GZIP_WBITS)
+    return zlib.decompressobj(GZIP_WBITS)
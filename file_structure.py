@@ -1,8 +1,118 @@
 import os
 import re
+import fnmatch
 import stat
-import json
-import datetime
+import pickle
+import tempfile
+import time
+from types import MappingProxyType
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from threading import Lock
+from serializer import dump_json, load_json
+from transfer import join_root
+
+GITIGNORE_CACHE_SIZE = 500
+DUMP_BATCH_SIZE = 4096
+STAT_DIR_FD = os.stat in os.supports_dir_fd
+RACY_WINDOW = 2 * 10**9
+gitignore_cache = OrderedDict()
+gitignore_lock = Lock()
+
+
+def load_gitignore(gitignore_path):
+    """
+    Gets compiled exclusion pattern for a gitignore. Patterns are cached by
+    path across File_Structure instances and only re-read when the gitignore
+    modification time changes.
+
+    Args:
+        gitignore_path (str): Path to gitignore file.
+
+    Returns:
+        Pattern: Compiled exclusion regex or None.
+    """
+    last_mod = os.stat(gitignore_path).st_mtime
+    with gitignore_lock:
+        cached = gitignore_cache.get(gitignore_path)
+    if cached is not None and cached[0] == last_mod:
+        return cached[1]
+    pattern = parse_gitignore(gitignore_path)
+    with gitignore_lock:
+        gitignore_cache[gitignore_path] = (last_mod, pattern)
+        if len(gitignore_cache) > GITIGNORE_CACHE_SIZE:
+            gitignore_cache.popitem(last=False)
+    return pattern
+
+
+def parse_gitignore(gitignore_path):
+    """
+    Parse gitignore into a single compiled exclusion pattern.
+
+    Args:
+        gitignore_path (str): Path to gitignore file.
+
+    Returns:
+        Pattern: Compiled alternation of exclusion regexs or None if the
+        gitignore has no patterns.
+    """
+    with open(gitignore_path, 'r') as f:
+        lines = [line.strip().strip('/') for line in f]
+    ignore_patterns = [fnmatch.translate(line) for line in lines
+                        if line and line[0] != '#']
+    if len(ignore_patterns) == 0:
+        return None
+    return re.compile('|'.join(ignore_patterns))
+
+
+class File_Info:
+    """
+    Compact record of a single file structure object. Supports dictionary style
+    access so it can be used interchangeably with remote structure dictionaries.
+    """
+
+    __slots__ = ('type', 'perm', 'size', 'last_mod', 'deleted')
+
+    def __init__(self, type, perm, size, last_mod, deleted=None):
+        """
+        Initializes file information record.
+
+        Args:
+            type (int): 1 if directory, 0 if file.
+            perm (int): Object mode bits.
+            size (int): Object size in bytes.
+            last_mod (int): Last modification timestamp.
+            deleted (float, optional): Deletion timestamp. Defaults to None.
+        """
+        self.type = type
+        self.perm = perm
+        self.size = size
+        self.last_mod = last_mod
+        self.deleted = deleted
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def __repr__(self):
+        return repr(self.to_dict())
+
+    def to_dict(self):
+        """
+        Gets file information as a dictionary.
+
+        Returns:
+            dict: File object information
+        """
+        return {
+            'type': self.type,
+            'perm': self.perm,
+            'size': self.size,
+            'last_mod': self.last_mod,
+            'deleted': self.deleted,
+        }
 
 
 class File_Structure:
@@ -26,13 +136,16 @@ class File_Structure:
 
         self.__gitignore = gitignore
         self.__purge_limit = purge_limit
+        self.__workers = min(32, (os.cpu_count() or 1) * 4)
+        self.__listings = {}
         home_dir = os.path.expanduser('~')
 
         stripped_root = os.path.basename(os.path.normpath(self.__root))
         conf_path = os.path.join(home_dir, '.conf')
         conf_path = os.path.join(conf_path, 'pysync')
         self.__user_conf_path = os.path.join(conf_path, stripped_root)
-        self.__json_path = os.path.join(self.__user_conf_path, stripped_root+'.json')
+        self.__store_path = os.path.join(self.__user_conf_path, stripped_root+'.pickle')
+        self.__legacy_path = os.path.join(self.__user_conf_path, stripped_root+'.json')
         
         self.__structure = self.__get_structure()
         
@@ -46,42 +159,172 @@ class File_Structure:
         old_structure = self.__read_old_structure()
         new_structure = self.__build_file_structure()
         if old_structure is not None:
-            old_structure = self.__check_deletions(old_structure)
-            return {**old_structure, **new_structure}
+            return self.__check_deletions({**old_structure, **new_structure},
+                                            new_structure)
         return new_structure
 
     def __read_old_structure(self):
         """
-        Grabs old file structure from previous syncs.
+        Grabs old file structure from previous syncs. If no pickle has been
+        saved yet, or it cannot be read, the json store of earlier versions is
+        read instead so deletion records carry over.
 
         Returns:
             dict: Old file structure dictionary.
         """
-        if os.path.exists(self.__json_path):
-            with open(self.__json_path, 'r') as file:
-                return json.load(file)
+        if os.path.exists(self.__store_path):
+            try:
+                with open(self.__store_path, 'rb') as file:
+                    return pickle.load(file)
+            except (OSError, EOFError, pickle.UnpicklingError, AttributeError,
+                    ValueError):
+                pass
+        if os.path.exists(self.__legacy_path):
+            return self.__read_legacy_structure()
         return None
 
+    def __read_legacy_structure(self):
+        """
+        Reads a json store of earlier versions, which keyed objects by
+        absolute path and recorded the root under a 'root' key.
+
+        Returns:
+            dict: Old file structure dictionary, or None if the store cannot
+            be read.
+        """
+        try:
+            with open(self.__legacy_path, 'rb') as file:
+                legacy = load_json(file.read())
+            root = legacy.pop('root', self.__root)
+            return {'.' + path[len(root):]: File_Info(**info)
+                    for path, info in legacy.items() if path.startswith(root + os.sep)}
+        except (OSError, ValueError, TypeError, AttributeError):
+            return None
+
     def __build_file_structure(self):
         """
-        Builds new file structure dictionary from local files.
+        Builds new file structure dictionary from local files. Paths are
+        stored relative to the root.
 
         Returns:
             dict: New file structure dictionary.
         """
-        paths = []
-        for root, _dirs, _files in os.walk(self.__root, topdown=True):
-            if self.__gitignore and '.gitignore' in _files:
-                _dirs, _files = self.__pattern_filter(_dirs, _files, self.__process_gitignore(root))
-            _paths = _dirs + _files
-            for path in _paths:
-                paths.append(os.path.join(root, path))
-
-        file_structure = {'root': self.__root}
-        for path in paths:
-            file_structure[path] = self.__discover(path)
+        file_structure = {}
+        listings = {}
+        self.__scan_start = time.time_ns()
+        try:
+            status = os.stat(self.__root)
+            pending = [('.', (status.st_mtime_ns, status.st_ctime_ns))]
+        except OSError:
+            return file_structure
+        with ThreadPoolExecutor(max_workers=self.__workers) as executor:
+            while pending:
+                scanned = executor.map(self.__scan_directory, pending)
+                pending = []
+                for directory, listing, infos, dirs in scanned:
+                    if listing is not None:
+                        listings[directory] = listing
+                    file_structure.update(infos)
+                    pending.extend(dirs)
+        self.__listings = listings
         return file_structure
 
+    def __scan_directory(self, pending):
+        """
+        Scans a single directory for file structure objects. Directories whose
+        modification and change times have not changed since the last scan
+        reuse their previous listing instead of being read again. The change
+        time catches entries added under a restored modification time, and
+        listings of directories changed within RACY_WINDOW of the scan start
+        are not cached, since a later change in the same timestamp tick would
+        go unnoticed.
+
+        Args:
+            pending (Tuple(str, Tuple(int, int))): Relative path of directory
+            to scan and its modification and change times in nanoseconds.
+
+        Returns:
+            Tuple(str, Tuple, list, list): Directory scanned, listing to cache
+            or None, list of (path, File_Info) pairs and list of
+            (path, times) subdirectories to descend into.
+        """
+        directory, times = pending
+        root = join_root(self.__root, directory)
+        infos = []
+        dirs = []
+        listing = self.__listings.get(directory)
+        if listing is not None and listing[0] == times:
+            for name, descend, status in self.__stat_listing(root, listing[1]):
+                path = directory + os.sep + name
+                infos.append((path, File_Info(
+                    int(stat.S_ISDIR(status.st_mode)), status.st_mode,
+                    status.st_size, int(status.st_mtime))))
+                if descend:
+                    dirs.append((path, (status.st_mtime_ns, status.st_ctime_ns)))
+            return directory, listing, infos, dirs
+
+        try:
+            with os.scandir(root) as scanner:
+                entries = list(scanner)
+        except OSError:
+            return directory, None, infos, dirs
+        cacheable = True
+        if self.__gitignore and any(entry.name == '.gitignore' for entry in entries):
+            entries = self.__pattern_filter(entries, self.__process_gitignore(root))
+            cacheable = False
+        names = []
+        for entry in entries:
+            path = directory + os.sep + entry.name
+            descend = entry.is_dir(follow_symlinks=False)
+            names.append((entry.name, descend))
+            try:
+                status = entry.stat()
+            except OSError:
+                continue
+            infos.append((path, File_Info(
+                int(stat.S_ISDIR(status.st_mode)), status.st_mode,
+                status.st_size, int(status.st_mtime))))
+            if descend:
+                dirs.append((path, (status.st_mtime_ns, status.st_ctime_ns)))
+        if not cacheable or self.__scan_start - max(times) < RACY_WINDOW:
+            return directory, None, infos, dirs
+        return directory, (times, tuple(names)), infos, dirs
+
+    def __stat_listing(self, root, names):
+        """
+        Stats the entries of a cached directory listing. Where supported the
+        directory is opened once and entries are resolved relative to it, so
+        the full path is not walked again for every entry. Entries that can
+        no longer be found are skipped.
+
+        Args:
+            root (str): Absolute path of the directory.
+            names (Tuple): Cached (name, descend) pairs of the directory.
+
+        Yields:
+            Tuple(str, bool, stat_result): Name, whether to descend and
+            status of each entry.
+        """
+        if not STAT_DIR_FD:
+            for name, descend in names:
+                try:
+                    yield name, descend, os.stat(root + os.sep + name)
+                except OSError:
+                    continue
+            return
+        try:
+            dir_fd = os.open(root, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            for name, descend in names:
+                try:
+                    yield name, descend, os.stat(name, dir_fd=dir_fd)
+                except OSError:
+                    continue
+        finally:
+            os.close(dir_fd)
+
     def __process_gitignore(self, root):
         """
         Parse gitignore for exclusion patterns.
@@ -90,138 +333,137 @@ class File_Structure:
             root (str): Root path
 
         Returns:
-            list: List of regexs for exclusion.
+            Pattern: Compiled exclusion regex or None.
         """
         gitignore_path = os.path.join(root, '.gitignore')
-        with open(gitignore_path, 'r') as f:
-            lines = f.readlines()
-        while '\n' in lines:
-            lines.remove('\n')
-        ignore_patterns = []
-        for line in lines:
-            line = line.strip()
-            line = line.strip('/')
-            line = line.replace('*', r'.*')
-            line = line.replace('.', r'\.')
-            line = line.replace('[', r'\[')
-            line = line.replace(']', r'\]')
-            if line[0] != '#':
-                ignore_patterns.append(line)
-        return ignore_patterns
-
-    def __pattern_filter(self, dirs, files, ignore_patterns):
-        """
-        Filters directories and files by patterns.
-
-        Args:
-            dirs (list): List of directories.
-            files (list): List of files.
-            ignore_patterns (list): List of regular expressions.
+        return load_gitignore(gitignore_path)
 
-        Returns:
-            Tuple(list, list): Tuple of directories and files.
-        """
-        remove_dirs = []
-        remove_files = []
-        for pattern in ignore_patterns:
-            for dir in dirs:
-                if re.match(pattern, dir) is not None:
-                    remove_dirs.append(dir)
-            for file in files:
-                if re.match(pattern, file) is not None:
-                    remove_files.append(file)
-        for _dir in remove_dirs:
-            dirs.remove(_dir)
-        for _file in remove_files:
-            files.remove(_file)
-        return dirs, files
-
-    def __discover(self, path):
-        """
-        Get information on path object.
+    def __pattern_filter(self, entries, ignore_pattern):
+        """
+        Filters directory entries by pattern.
 
         Args:
-            path (str): Object path
+            entries (list): List of DirEntry objects.
+            ignore_pattern (Pattern): Compiled exclusion regex or None.
 
         Returns:
-            dict: File object information
+            list: List of DirEntry objects not excluded.
         """
-        status = os.stat(path)
-        info = {
-            'type': int(stat.S_ISDIR(status[stat.ST_MODE])),
-            'perm': status[stat.ST_MODE],
-            'size': status[stat.ST_SIZE],
-            'last_mod': status[stat.ST_MTIME],
-            'deleted': None,
-        }
-        return info
+        if ignore_pattern is None:
+            return entries
+        return [entry for entry in entries if ignore_pattern.match(entry.name) is None]
 
-    def __check_deletions(self, structure):
+    def __check_deletions(self, structure, scanned):
         """
-        Checks if old paths have been deleted and removes stale deletions.
+        Checks if old paths have been deleted and removes stale deletions in
+        place. Records are replaced rather than modified so snapshots handed
+        out by get_structure never change underneath their readers.
 
         Args:
             structure (dict): File structure dictionary.
+            scanned (dict): Paths found by the latest scan, which are known
+            to exist.
 
         Returns:
             dict: File structure dictionary.
         """
-        _structure = structure.copy()
-        for path, info in structure.items():
-            if path == 'root':
-                continue
-            if info['deleted'] is None:
-                if not os.path.exists(path):
-                    timestamp = datetime.datetime.now().timestamp()
-                    _structure[path]['deleted'] = timestamp
-                    _structure[path]['last_mod'] = timestamp
-            else:
-                delete_time = datetime.datetime.fromtimestamp(info['deleted'])
-                now_time = datetime.datetime.now()
-                delta = now_time - delete_time
-                if self.__purge_limit is not None and delta.days > self.__purge_limit:
-                    del _structure[path]
-        structure = _structure
+        timestamp = time.time()
+        purge_cutoff = None
+        if self.__purge_limit is not None:
+            purge_cutoff = timestamp - (self.__purge_limit + 1) * 86400
+        unchecked = {}
+        for path in list(structure):
+            info = structure[path]
+            if info.deleted is None:
+                if path in scanned:
+                    continue
+                unchecked.setdefault(os.path.dirname(path), []).append(path)
+            elif purge_cutoff is not None and info.deleted <= purge_cutoff:
+                del structure[path]
+        for parent, paths in unchecked.items():
+            names = self.__list_names(join_root(self.__root, parent))
+            for path in paths:
+                if names is not None:
+                    exists = os.path.basename(path) in names
+                else:
+                    exists = os.path.exists(join_root(self.__root, path))
+                if not exists:
+                    info = structure[path]
+                    structure[path] = File_Info(info.type, info.perm, info.size,
+                                                timestamp, timestamp)
         return structure
 
+    def __list_names(self, parent):
+        """
+        Lists names within a directory with a single scan.
+
+        Args:
+            parent (str): Directory path.
+
+        Returns:
+            set: Set of names in the directory or None if the directory could
+            not be listed.
+        """
+        try:
+            with os.scandir(parent) as scanner:
+                return {entry.name for entry in scanner}
+        except (FileNotFoundError, NotADirectoryError):
+            return set()
+        except OSError:
+            return None
+
     def update_structure(self):
         """
         Updates structure in RAM.
         """
-        structure = self.__check_deletions(self.__structure)
         new_structure = self.__build_file_structure()
-        self.__structure = {**structure, **new_structure}
+        self.__structure = self.__check_deletions(
+            {**self.__structure, **new_structure}, new_structure)
 
     def save_structure(self):
         """
-        Saves file structure to disk.
+        Saves file structure to disk. The structure is written to a temporary
+        file that then replaces the store, so an interrupted save leaves the
+        previous store intact.
         """
         os.makedirs(self.__user_conf_path, exist_ok=True)
-        with open(self.__json_path, 'w+') as file:
-            json.dump(self.__structure, file, indent=4)
+        descriptor, temp_path = tempfile.mkstemp(dir=self.__user_conf_path,
+                                                    suffix='.tmp')
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                pickle.dump(self.__structure, file, protocol=5)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temp_path, self.__store_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
 
     def dump_structure(self):
         """
-        Gets file structure in bytes
+        Gets file structure in bytes. The structure is split into json
+        objects of up to DUMP_BATCH_SIZE paths, one per line, so it can be
+        parsed as it is received.
 
         Returns:
-            bytes: File structure dictionary as json dumps byte stream.
+            bytes: Newline delimited json byte stream.
         """
-        new_structure = {}
-        for path in self.__structure.keys():
-            _path = path.replace(self.__root, '.', 1)
-            new_structure[_path] = self.__structure[path]
-        new_structure.pop('root')
-        return json.dumps(new_structure)
+        items = list(self.__structure.items())
+        return b'\n'.join(
+            dump_json(dict(items[start:start + DUMP_BATCH_SIZE]),
+                        default=File_Info.to_dict)
+            for start in range(0, len(items), DUMP_BATCH_SIZE))
 
     def get_structure(self):
         """
-        Get copy of file structure dictionary.
+        Get read only view of file structure dictionary. Paths are relative to
+        the root. Updates build a new dictionary, so a view is a consistent
+        snapshot that can be shared between threads without copying.
 
         Returns:
-            dict: File structure dictionary copy.
+            MappingProxyType: File structure dictionary view.
         """
-        return self.__structure.copy()
+        return MappingProxyType(self.__structure)
 
     def print_structure(self):
         """
@@ -0,0 +1,148 @@
+import socket
+import struct
+from exceptions import MissSpeakException, SkipResponseException
+
+HEADER = struct.Struct('!I')
+MAX_MSG_SIZE = 1 << 24
+READ_BUFFER = 1 << 16
+SOCKET_BUFFER = 0
+CHUNKED = -1
+SKIP_CHUNK = 0xFFFFFFFF
+END_FRAME = HEADER.pack(0)
+SKIP_FRAME = HEADER.pack(SKIP_CHUNK)
+SKIP_SIGNAL = b'!!SKIP!!SKIP!!'
+
+
+def frame(payload):
+    """
+    Prefixes a control message with its length.
+
+    Args:
+        payload (bytes): Message to frame.
+
+    Returns:
+        bytes: Framed message.
+    """
+    return HEADER.pack(len(payload)) + payload
+
+
+def send_msg(conn, payload):
+    """
+    Sends a control message prefixed with its length.
+
+    Args:
+        conn (Socket): Connected socket.
+        payload (bytes): Message to send.
+    """
+    conn.sendall(frame(payload))
+
+
+def set_socket_buffers(sock):
+    """
+    Sets the kernel send and receive buffer sizes of a socket to
+    SOCKET_BUFFER. Fixing the sizes turns off the kernel's buffer
+    autotuning, which usually picks larger windows on fast links, so
+    nothing is set while SOCKET_BUFFER is 0.
+
+    Args:
+        sock (Socket): Socket to configure, before it connects or listens.
+    """
+    if SOCKET_BUFFER > 0:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, SOCKET_BUFFER)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, SOCKET_BUFFER)
+
+
+def make_reader(conn):
+    """
+    Wraps a connected socket in a buffered reader. Every read from the
+    connection must go through the same reader, since it may hold bytes
+    that have already been received.
+
+    Args:
+        conn (Socket): Connected socket.
+
+    Returns:
+        BufferedReader: Buffered reader over the socket.
+    """
+    return conn.makefile('rb', buffering=READ_BUFFER)
+
+
+def recv_msg(reader):
+    """
+    Receives a single length prefixed control message.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+
+    Raises:
+        MissSpeakException: Raised if the announced length is implausible.
+
+    Returns:
+        bytes: Message received.
+    """
+    byte_total, = HEADER.unpack(recv_exact(reader, HEADER.size))
+    if byte_total > MAX_MSG_SIZE:
+        raise MissSpeakException('MSG Size')
+    return bytes(recv_exact(reader, byte_total))
+
+
+def recv_exact(reader, byte_total):
+    """
+    Receives exactly byte_total bytes.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+        byte_total (int): Number of bytes to receive.
+
+    Raises:
+        MissSpeakException: Raised if the connection closes early.
+
+    Returns:
+        bytearray: Bytes received.
+    """
+    data = bytearray(byte_total)
+    with memoryview(data) as view:
+        recv_into(reader, view)
+    return data
+
+
+def recv_into(reader, view):
+    """
+    Fills a buffer from the connection.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+        view (memoryview): Buffer to fill.
+
+    Raises:
+        MissSpeakException: Raised if the connection closes early.
+    """
+    byte_total = len(view)
+    byte_count = 0
+    while byte_count < byte_total:
+        received = reader.readinto(view[byte_count:])
+        if not received:
+            raise MissSpeakException('RECV Closed')
+        byte_count += received
+
+
+def recv_chunk_size(reader):
+    """
+    Receives the length prefix of the next chunk of a chunked stream. A
+    chunked stream is announced with a size of CHUNKED and ends with an
+    empty chunk.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+
+    Raises:
+        SkipResponseException: Raised if the sender aborted the stream.
+        MissSpeakException: Raised if the connection closes early.
+
+    Returns:
+        int: Size of the next chunk, or 0 at the end of the stream.
+    """
+    byte_total, = HEADER.unpack(recv_exact(reader, HEADER.size))
+    if byte_total == SKIP_CHUNK:
+        raise SkipResponseException()
+    return byte_total
@@ -1,6 +1,8 @@
 from datetime import datetime
 import os
 
+LOG_CHUNK = 65536
+
 class Logger:
     """
     Handles logging for client and server.
@@ -23,6 +25,8 @@ class Logger:
         self.__remote_host = remote_host
         self.__thread = thread
         self.__logging_limit = logging_limit
+        self.__log_file = None
+        self.__log_size = 0
 
     def __stamp(self):
         """
@@ -52,28 +56,58 @@ class Logger:
 
     def __log(self, message):
         """
-        Logs message to file.
+        Logs message to file. The log file is kept open between messages and
+        its size is tracked in memory.
 
         Args:
             message (str): Log
         """
-        message = self.__stamp() + ' - ' + message + '\n'
-        with open(self.__log_path, 'a+') as file:
-            file.write(message)
-        if self.__logging_limit != -1:
+        message = (self.__stamp() + ' - ' + message + '\n').encode()
+        if self.__log_file is None:
+            self.__log_file = open(self.__log_path, 'ab')
+            self.__log_size = self.__log_file.tell()
+        self.__log_file.write(message)
+        self.__log_file.flush()
+        self.__log_size += len(message)
+        if self.__logging_limit != -1 and self.__log_size > self.__logging_limit:
             self.__check_log_size()
+
+    def close(self):
+        """
+        Closes the log file.
+        """
+        if self.__log_file is not None:
+            self.__log_file.close()
+            self.__log_file = None
         
     def __check_log_size(self):
         """
-        Ensures log does not exceed log file size limit.
+        Ensures log does not exceed log file size limit. Drops the oldest lines
+        by copying the remaining tail to the start of the file in chunks and
+        truncating.
         """
         file_size = os.path.getsize(self.__log_path)
         if file_size > self.__logging_limit:
-            distance = file_size - self.__logging_limit - 1
+            read_pos = file_size - self.__logging_limit
             with open(self.__log_path, 'rb+') as log_file:
-                log_file.seek(distance)
-                newline_distance = log_file.read().find(b'\n')
-                if newline_distance != -1:
-                    distance += newline_distance
-                log_file.seek(distance)
-                log_file.write(log_file.read())
+                log_file.seek(read_pos)
+                chunk = log_file.read(LOG_CHUNK)
+                while chunk:
+                    newline_distance = chunk.find(b'\n')
+                    if newline_distance != -1:
+                        read_pos += newline_distance + 1
+                        break
+                    read_pos += len(chunk)
+                    chunk = log_file.read(LOG_CHUNK)
+                write_pos = 0
+                while True:
+                    log_file.seek(read_pos)
+                    chunk = log_file.read(LOG_CHUNK)
+                    if not chunk:
+                        break
+                    read_pos += len(chunk)
+                    log_file.seek(write_pos)
+                    log_file.write(chunk)
+                    write_pos += len(chunk)
+                log_file.truncate(write_pos)
+        self.__log_size = os.path.getsize(self.__log_path)
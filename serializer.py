@@ -0,0 +1,38 @@
+import json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dump_json(obj, default=None):
+    """
+    Serializes object to compact json bytes, using orjson when available.
+
+    Args:
+        obj (object): Json serializable object.
+        default (callable, optional): Converts objects json cannot serialize
+        natively. Defaults to None.
+
+    Returns:
+        bytes: Json byte stream.
+    """
+    if orjson is not None:
+        return orjson.dumps(obj, default=default)
+    return json.dumps(obj, default=default, separators=(',', ':')).encode()
+
+
+def load_json(data):
+    """
+    Deserializes json bytes, using orjson when available. Decoding errors are
+    raised as json.JSONDecodeError in both cases.
+
+    Args:
+        data (bytes): Json byte stream.
+
+    Returns:
+        object: Deserialized object.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
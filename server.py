@@ -1,10 +1,19 @@
 import socket
 from server_thread import ServerThread
+from framing import set_socket_buffers
 from file_structure import File_Structure
 import ssl
 import time
-from threading import Thread
-import threading
+from threading import Thread, Lock
+from concurrent.futures import ThreadPoolExecutor
+import weakref
+import traceback
+from functools import partial
+
+thread_locks = weakref.WeakValueDictionary()
+thread_locks_guard = Lock()
+MAX_THREADS = 32
+active_threads = set()
 
 
 def update_struct(structure):
@@ -18,33 +27,40 @@ def update_struct(structure):
     while True:
         structure.update_structure()
         structure.save_structure()
-        server_struct = structure.get_structure().copy()
+        server_struct = structure.get_structure()
         time.sleep(5)
 
 
-def clean_locks():
+def finish_thread(thread, future):
     """
-    Cleans thread lock list repeatedly for memory consumption reasons.
+    Done callback of a submitted server thread. Prints the traceback of any
+    exception the thread did not handle, which the executor would otherwise
+    keep silently in the future. Threads cancelled before they ran have
+    their connection shut down.
+
+    Args:
+        thread (ServerThread): Server thread that was submitted.
+        future (Future): Future of the thread's run method.
     """
-    global thread_locks
-    while True:
-        keys = list(thread_locks.keys())
-        for key in keys:
-            if thread_locks[key][0] <= 0:
-                del thread_locks[key]
-        time.sleep(2)
+    active_threads.discard(thread)
+    if future.cancelled():
+        thread.terminate()
+        return
+    error = future.exception()
+    if error is not None:
+        traceback.print_exception(type(error), error, error.__traceback__)
 
 
 def server_start(conf):
     """
     Starts server and spawns off server threads for new client connections.
+    On Ctrl-C no new connections are accepted and active syncs are allowed
+    to finish; a second Ctrl-C aborts them.
 
     Args:
         conf (dict): Configuration dictionary.
     """
     global server_struct
-    global thread_locks
-    thread_locks = {}
     
     socket.setdefaulttimeout(conf['timeout'])
     structure = File_Structure(
@@ -54,16 +70,16 @@ def server_start(conf):
         context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
         context.load_cert_chain(certfile=conf['cert'], keyfile=conf['key'])
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        set_socket_buffers(sock)
         sock.bind((conf['hostname'], conf['port']))
         sock.listen(5)
         
         struct_updater = Thread(target=update_struct, args=[structure],
                                 daemon=True, name='Structure_Updater')
         struct_updater.start()
-        lock_cleaner = Thread(target=clean_locks, daemon=True, name='Lock_Cleaner')
-        lock_cleaner.start()
         
-        threads = []
+        executor = ThreadPoolExecutor(max_workers=MAX_THREADS,
+                                        thread_name_prefix='Server_Thread')
         try:
             while True:
                 try:
@@ -71,20 +87,21 @@ def server_start(conf):
                 except socket.timeout:
                     continue
                 print(f'Connected to {addr}')
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 if conf['encryption']:
                     conn = context.wrap_socket(conn, server_side=True)
-                thread = ServerThread(conn, addr, server_struct.copy(), conf.copy())
-                thread.start()
-                threads.append(thread)
-
-                _threads = threads.copy()
-                for thread in threads:
-                    thread.join(0)
-                    if not thread.is_alive():
-                        _threads.remove(thread)
-                threads = _threads
+                thread = ServerThread(conn, addr, server_struct, conf.copy())
+                active_threads.add(thread)
+                future = executor.submit(thread.run)
+                future.add_done_callback(partial(finish_thread, thread))
         except KeyboardInterrupt:
             struct_updater.join(0)
-            lock_cleaner.join(0)
-            for thread in threads:
-                thread.join(0)
+            sock.close()
+            print('Waiting for active syncs to finish. '
+                    + 'Press Ctrl-C again to abort them.')
+            try:
+                executor.shutdown(cancel_futures=True)
+            except KeyboardInterrupt:
+                for thread in list(active_threads):
+                    thread.terminate()
+                executor.shutdown()
@@ -1,21 +1,84 @@
-from datetime import datetime
-import stat
-import zlib
 from logger import Logger
 from structure_comparer import Structure_Comparer
-from threading import Thread
+from threading import Lock
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
 import socket
 import json
-import gzip
-from tempfile import gettempdir
 import shutil
 import os
 import random
+import hashlib
+import secrets
+import time
 from exceptions import *
 from thread_locker import File_Thread_Locker
+from serializer import dump_json, load_json
+from framing import (CHUNKED, SKIP_FRAME, SKIP_SIGNAL, frame, make_reader,
+                        send_msg, recv_msg)
+from compression import compress, zlib_decompressor
+from transfer import (RECV_CHUNK, compress_file, join_root, keep_compressed,
+                        keep_limit, make_directory, purge_directory, recv_buffers,
+                        recv_file, send_compressed, send_uncompressed)
+
+HEAD_CHUNK = 1 << 16
+MIN_RAM = 1 << 16
+CONFIRM_BATCH_SIZE = 1000
+PIPELINE_DEPTH = 64
+STRUCT_CACHE_ENTRIES = 1 << 20
+PURGE_INTERVAL = 3600
+struct_cache = OrderedDict()
+struct_cache_entries = 0
+struct_lock = Lock()
+purge_lock = Lock()
+last_purge = {}
+
+
+def get_cached_struct(client_mac, struct_hash):
+    """
+    Gets the structure last received from a client if its content hash is
+    unchanged.
+
+    Args:
+        client_mac (str): MAC address the client reported.
+        struct_hash (str): Hash of the client's serialized file structure.
 
+    Returns:
+        dict: Client file structure dictionary or None if not cached.
+    """
+    with struct_lock:
+        cached = struct_cache.get(client_mac)
+        if cached is None or cached[0] != struct_hash:
+            return None
+        struct_cache.move_to_end(client_mac)
+        return cached[1]
 
-class ServerThread(Thread):
+
+def cache_struct(client_mac, struct_hash, struct):
+    """
+    Caches the structure received from a client, replacing any earlier one
+    from the same client. Least recently used structures are evicted once
+    the cache holds more than STRUCT_CACHE_ENTRIES paths in total.
+
+    Args:
+        client_mac (str): MAC address the client reported.
+        struct_hash (str): Verified hash of the client's serialized file
+        structure.
+        struct (dict): Client file structure dictionary.
+    """
+    global struct_cache_entries
+    with struct_lock:
+        previous = struct_cache.pop(client_mac, None)
+        if previous is not None:
+            struct_cache_entries -= len(previous[1])
+        struct_cache[client_mac] = (struct_hash, struct)
+        struct_cache_entries += len(struct)
+        while struct_cache_entries > STRUCT_CACHE_ENTRIES and struct_cache:
+            _, (_, evicted) = struct_cache.popitem(last=False)
+            struct_cache_entries -= len(evicted)
+
+
+class ServerThread:
     """
     Server Thread class. Responsible for handling independent client 
     connections.
@@ -23,28 +86,29 @@ class ServerThread(Thread):
 
     def __init__(self, conn, addr, server_struct, conf):
         """
-        Builds server thread. Call with start() method.
+        Builds server thread. Submit run() to an executor or call it
+        directly.
 
         Args:
             conn (Socket): Socket with active connection between client and
             server.
             addr (tuple): Tuple of IP and port of client.
-            server_struct (dict): Local file structure dictionary.
+            server_struct (MappingProxyType): Read only local file structure
+            snapshot.
             conf (dict): Configuration dictionary for server thread.
         """
         self.__conn = conn
+        self.__reader = make_reader(conn)
         self.__server_struct = server_struct
         self.__root = conf['root']
         self.__configure(conf)
-
-        Thread.__init__(self)
-        self.setName(datetime.now().microsecond)
-        self.setDaemon(True)
+        self.__name = secrets.token_hex(4)
         
         self.__logger = Logger(self.__conf['logging'], self.__conf_path,
                                 addr[0], self.__conf['logging_limit'],
-                                thread=self.getName())
+                                thread=self.__name)
         self.__dir_mods = []
+        self.__recv_pool = []
         
     def __configure(self, conf):
         """
@@ -70,11 +134,13 @@ class ServerThread(Thread):
         Main function of started Server thread. Performs sync between client and
         server.
         """
-        start_time = datetime.now()
+        start_time = time.perf_counter_ns()
+        self.__writer = ThreadPoolExecutor(max_workers=1,
+                                            thread_name_prefix='File_Writer')
         try:
             self.__sync_configs()
             self.__process()
-            self.__conn.sendall(b'BYE')
+            send_msg(self.__conn, b'BYE')
         except socket.timeout:
             self.__logger.log('Connection timeout with client.', 1)
         except json.JSONDecodeError:
@@ -87,28 +153,30 @@ class ServerThread(Thread):
         finally:
             try:
                 self.__conn.shutdown(socket.SHUT_RDWR)
+                self.__reader.close()
                 self.__conn.close()
             except:
                 pass
+            self.__writer.shutdown()
             self.__logger.log('Connection with Client closed.', 2)
             if self.__conf['backup_limit'] is not None:
                     self.__purge_backups()
             self.__timeshift_dirs()
-            time_elapsed = datetime.now() - start_time
-            self.__logger.log(f'Time elapsed {time_elapsed}.', 2)
+            time_elapsed = (time.perf_counter_ns() - start_time) / 1e6
+            self.__logger.log(f'Time elapsed {time_elapsed:.1f} ms.', 2)
+            self.__logger.close()
 
     def __sync_configs(self):
         """
-        Syncs configuration between Server and Client.
-
-        Raises:
-            MissSpeakException: Raised if configuration sync client
-            acknowledgment fails.
+        Syncs configuration between Server and Client in a single round
+        trip. The agreed configuration is sent back to the client, which
+        adopts it without echoing it.
         """
         self.__logger.log('Syncing configuration...', 2)
-        data = self.__conn.recv(1024)
-        client_conf = json.loads(data)
+        data = recv_msg(self.__reader)
+        client_conf = load_json(data)
         self.__logger.log(f'Client MAC address: {client_conf["MAC"]}', 2)
+        self.__client_mac = str(client_conf['MAC'])
         self.__conf['purge'] = client_conf['purge'] and self.__conf['purge']
         client_conf['purge'] = self.__conf['purge']
         self.__conf['compression'] = min(client_conf['compression'], self.__conf['compression'])
@@ -117,15 +185,11 @@ class ServerThread(Thread):
             self.__conf['compression_min'] = max(
                 min(client_conf['compression_min'], self.__conf['compression_min']), 0)
         client_conf['compression_min'] = self.__conf['compression_min']
-        self.__conf['ram'] = min(client_conf['ram'], self.__conf['ram'])
+        limits = [ram for ram in (client_conf['ram'], self.__conf['ram']) if ram != -1]
+        self.__conf['ram'] = max(min(limits), MIN_RAM) if limits else -1
         client_conf['ram'] = self.__conf['ram']
 
-        conf_stream = json.dumps(client_conf).encode()
-        self.__conn.sendall(conf_stream)
-        data = self.__conn.recv(1024)
-        if data != conf_stream:
-            self.__logger.log('Configuration sync failed.', 1)
-            raise MissSpeakException('CONF SYNC FAIL')
+        send_msg(self.__conn, dump_json(client_conf))
         self.__logger.log('Synced configured.', 2)
 
     def __process(self):
@@ -133,8 +197,7 @@ class ServerThread(Thread):
         Performs file synchronization steps.
         """
         self.__client_struct = self.__request_struct()
-        comparer = Structure_Comparer(self.__server_struct.copy(),
-                                        self.__client_struct.copy())
+        comparer = Structure_Comparer(self.__server_struct, self.__client_struct)
         creates, deletes = comparer.compare_structures(self.__conf['purge'])
         self.__logger.log('Syncing Server and Client...', 2)
         if creates is not None and deletes is not None:
@@ -143,9 +206,12 @@ class ServerThread(Thread):
                 self.__handle_deletes(deletes)
         self.__logger.log('Synced Server and Client.', 2)
 
-    def __request_struct(self, error_count=0):
+    def __request_struct(self):
         """
-        Requests file structure dictionary from client.
+        Requests file structure dictionary from client. The client announces
+        a hash of its structure first and only sends it if the hash is not
+        cached from an earlier sync. Unexpected replies are retried up to five
+        times.
 
         Raises:
             MissSpeakException: Raises if client is not prepared to send file
@@ -154,49 +220,84 @@ class ServerThread(Thread):
         Returns:
             dict: Client file structure dictionary.
         """
-        self.__logger.log('Requesting struct...', 2)
-        self.__conn.sendall(b'REQUEST STRUCT')
-        data = self.__recv(1024, b'REQUEST STRUCT')
-        msg = data.decode('UTF-8').split(' ')
-        if msg[0] == 'STRUCT':
-            byte_total = msg[1]
-            struct_confirm = f'OK STRUCT {byte_total}'
-            self.__conn.sendall(struct_confirm.encode())
-            struct = self.__recv_bytes(int(byte_total))
-            self.__logger.log('Struct recieved.', 2)
+        for _ in range(5):
+            self.__logger.log('Requesting struct...', 2)
+            send_msg(self.__conn, b'REQUEST STRUCT')
+            data = self.__recv(b'REQUEST STRUCT')
+            msg = data.decode('UTF-8').split(' ')
+            if msg[0] != 'STRUCT' or len(msg) != 4:
+                continue
+            _, byte_total, struct_hash, compressed = msg
+            struct = get_cached_struct(self.__client_mac, struct_hash)
+            if struct is not None:
+                send_msg(self.__conn, b'OK CACHED')
+                self.__logger.log('Struct unchanged, using cached copy.', 2)
+                return struct
+            struct_confirm = f'OK STRUCT {byte_total} {struct_hash} {compressed}'
+            send_msg(self.__conn, struct_confirm.encode())
             try:
-                return json.loads(struct)
+                struct, received_hash = self.__recv_struct(int(byte_total),
+                                                            compressed == '1')
             except json.JSONDecodeError:
                 self.__logger.log('Json decode failed', 1)
                 raise MissSpeakException('STRUCT MissMatch')
-        else:
-            error_count += 1
-            if error_count >= 5:
-                self.__logger.log('Struct missmatch', 1)
-                raise MissSpeakException('STRUCT MissMatch')
+            self.__logger.log('Struct recieved.', 2)
+            if received_hash == struct_hash:
+                cache_struct(self.__client_mac, struct_hash, struct)
             else:
-                return self.__request_struct()
+                self.__logger.log('Struct hash mismatch, not caching.', 1)
+            return struct
+        self.__logger.log('Struct missmatch', 1)
+        raise MissSpeakException('STRUCT MissMatch')
 
-    def __recv_bytes(self, byte_total):
+    def __recv_struct(self, byte_total, compressed=False):
         """
-        Handles incoming bytes from client.
+        Receives the client's newline delimited structure and parses each
+        line as it arrives, so parsing overlaps the transfer and the whole
+        serialized structure is never held in memory. The serialized bytes
+        are hashed as they are parsed so the hash the client announced can be
+        checked before the structure is cached.
 
         Args:
             byte_total (int): Total number of bytes expected to be received.
+            compressed (bool, optional): Whether the bytes are zlib
+            compressed. Defaults to False.
+
+        Raises:
+            MissSpeakException: Raised if the connection closes early.
 
         Returns:
-            bytes: Bytes received from client.
-        """
-        data = b''
-        byte_chunk = min(self.__conf['ram'], byte_total)
-        while len(data) < byte_total:
-            if byte_chunk != -1:
-                data += self.__conn.recv(byte_chunk)
-            else:
-                data += self.__conn.recv()
-        if self.__conf['compression'] and byte_total >= self.__conf['compression_min']:
-            data = zlib.decompress(data)
-        return data
+            Tuple(dict, str): Client file structure dictionary and the hash of
+            its serialized bytes.
+        """
+        struct = {}
+        hasher = hashlib.blake2b(digest_size=16)
+        decompressor = zlib_decompressor() if compressed else None
+        view = memoryview(recv_buffers(self.__recv_pool, min(RECV_CHUNK, byte_total), 1)[0])
+        partial = b''
+        byte_count = 0
+        while byte_count < byte_total:
+            received = self.__reader.readinto1(
+                view[:min(len(view), byte_total - byte_count)])
+            if not received:
+                self.__logger.log('Connection closed while receiving bytes', 1)
+                raise MissSpeakException('RECV Closed')
+            byte_count += received
+            data = view[:received]
+            if decompressor is not None:
+                data = decompressor.decompress(data)
+            hasher.update(data)
+            lines = (partial + data).split(b'\n')
+            partial = lines.pop()
+            for line in lines:
+                struct.update(load_json(line))
+        if decompressor is not None:
+            data = decompressor.flush()
+            hasher.update(data)
+            partial += data
+        if partial:
+            struct.update(load_json(partial))
+        return struct, hasher.hexdigest()
 
     def __handle_creates(self, creates):
         """
@@ -229,13 +330,15 @@ class ServerThread(Thread):
         Args:
             dirs (list): List of directories to create.
         """
-        for _dir in dirs:
-            abs_path = _dir.replace('.', self.__root, 1)
+        client_struct = self.__client_struct
+        root = self.__root
+        prepared = [(_dir, root + _dir[1:], client_struct[_dir]['last_mod'])
+                    for _dir in sorted(dirs, key=lambda _dir: _dir.count(os.sep))]
+        created = set()
+        for _dir, abs_path, last_mod in prepared:
             self.__logger.log(f'Creating directory {_dir}...', 4)
-            last_mod = self.__client_struct[_dir]['last_mod']
             try:
-                os.makedirs(abs_path, exist_ok=True)
-                os.utime(abs_path, (last_mod, last_mod))
+                make_directory(abs_path, created)
                 self.__dir_mods.append((abs_path, (last_mod, last_mod)))
             except PermissionError:
                 self.__logger.log('Permssion error encountered creating '
@@ -246,246 +349,296 @@ class ServerThread(Thread):
 
     def __get_files(self, files):
         """
-        Retrieves files from client.
+        Retrieves files from client. Requests are pipelined: up to
+        PIPELINE_DEPTH requests are sent together and the responses are then
+        read back in order. A response that does not match its request cannot
+        be resynchronised, since file data follows it directly, so it ends
+        the session.
 
         Args:
             files (list(str)): List of file paths to retrieve.
+
+        Raises:
+            MissSpeakException: Raises if a response does not match its
+            request.
         """
-        error_count = 0
-        for path in files:
-            try:
-                self.__download_file(path)
-                error_count = 0
-            except MissSpeakException as error:
-                error_count += 1
-                if error_count >= 5:
-                    raise error
-            except SkipResponseException:
-                self.__logger.log('Client requested to directory creation.', 4)
+        for start in range(0, len(files), PIPELINE_DEPTH):
+            batch = files[start:start + PIPELINE_DEPTH]
+            self.__conn.sendall(b''.join(
+                frame(b'REQUEST ' + path.encode()) for path in batch))
+            for path in batch:
+                try:
+                    self.__download_file(path)
+                except SkipResponseException:
+                    self.__logger.log('Client requested to skip sending file.', 4)
 
     def __download_file(self, path):
         """
-        Requests file from client.
+        Receives a requested file from client. The file information is
+        followed directly by its data.
 
         Args:
             path (str): File path to download.
 
         Raises:
-            MissSpeakException: Client has not successfully acknowledged file
-            request
+            MissSpeakException: Client responded for a different file or the
+            connection closed early.
+            SkipResponseException: Client could not send the file.
         """
-        req = f'REQUEST {path}'
-        self.__conn.sendall(req.encode())
-    
-        data = self.__recv(1024, req.encode())
-        info = json.loads(data)
+        data = recv_msg(self.__reader)
+        if data == SKIP_SIGNAL:
+            raise SkipResponseException()
+        info = load_json(data)
         if info['path'] != path:
             self.__logger.log('File request error', 1)
             raise MissSpeakException('REQUEST File')
         byte_total = info['bytes']
-        ack = f"OK {byte_total}"
-        self.__conn.sendall(ack.encode())
         self.__logger.log(f'Receiving file {path} {byte_total}...', 4)
-        abs_path = path.replace('.', self.__root, 1)
-        if byte_total > 0:
-            try:
-                if self.__conf['compression'] and byte_total >= self.__conf['compression_min']:
-                    self.__recv_compressed_file(abs_path, byte_total)
-                else:
-                    self.__recv_file(abs_path, byte_total)
-            except PermissionError:
-                self.__conn.sendall(b'!!SKIP!!SKIP!!')
-                self.__logger.log('Permssion error encountered creating '
-                                    + f'file {abs_path}. Skipping...', 1)
-            except:
-                self.__conn.sendall(b'!!SKIP!!SKIP!!')
-                self.__logger.log('Unknown error encountered creating '
-                                    + f'file {abs_path}. Skipping...', 1)
-        else:
+        abs_path = join_root(self.__root, path)
+        compressed = self.__conf['compression'] and info['size'] >= self.__conf['compression_min']
+        try:
             with File_Thread_Locker(abs_path):
-                try:
+                if byte_total != 0:
+                    recv_file(self.__reader, self.__writer, abs_path, byte_total,
+                                self.__conf, self.__recv_pool, compressed)
+                else:
                     open(abs_path, 'w+').close()
-                except PermissionError:
-                    self.__logger.log('Permssion error encountered creating '
-                                        + f'file {abs_path}. Skipping...', 1)
-                except:
-                    self.__logger.log('Unknown error encountered creating '
-                                        + f'file {abs_path}. Skipping...', 1)
+        except (socket.timeout, ConnectionError):
+            raise
+        except OSError:
+            self.__logger.log('Error encountered creating '
+                                + f'file {abs_path}. Skipping...', 1)
+            return
         last_mod = int(info['last_mod'])
         try:
             os.utime(abs_path, (last_mod, last_mod))
-        except PermissionError:
+        except OSError:
             self.__logger.log(
-                'Permission error updating last modification time for file'
+                'Error updating last modification time for file '
                 + path, 1)
 
-    def __recv_file(self, abs_path, byte_total):
+    def __send_directories(self, dirs):
         """
-        Handles downloading of a remote file.
+        Commands the client to create directories in a single batch.
 
         Args:
-            abs_path (str): Absolute path of the file to be downloaded.
-            byte_total (int): Total bytes expected to be received.
-        """
-        with File_Thread_Locker(abs_path), open(abs_path, 'wb+') as file:
-            byte_count = 0
-            byte_chunk = min(self.__conf['ram'], byte_total)
-            skip_cache = b''
-            while byte_count < byte_total:
-                if byte_chunk != -1:
-                    data = self.__conn.recv(byte_chunk)
-                else:
-                    data = self.__conn.recv()
-                if b'!!SKIP!!SKIP!!' in skip_cache+data:
-                    raise SkipResponseException()
-                file.write(data)
-                byte_count += len(data)
-                skip_cache = data[-14:]
+            dirs (list): List of directories to remotely create.
 
-    def __recv_compressed_file(self, abs_path, byte_total):
+        Raises:
+            MissSpeakException: Raises if client fails to create directories.
         """
-        Handles downloading and decompression of remote file.
+        if len(dirs) == 0:
+            return
+        server_struct = self.__server_struct
+        batch = [[_dir, server_struct[_dir]['last_mod']] for _dir in dirs]
+        self.__logger.log(f'Sending {len(batch)} directories...', 4)
+        try:
+            self.__send_batch('MKDIR', batch)
+        except SkipResponseException:
+            self.__logger.log('Client requested to skip directory creation.', 4)
+
+    def __send_batch(self, command, batch):
+        """
+        Sends a batch of command arguments to the client as one json payload.
+        The payload is zlib compressed under the same rules as files.
 
         Args:
-            abs_path (str): Absolute path of the file to be downloaded.
-            byte_total (int): Total bytes expected to be received.
-        """
-        file_name = f'{datetime.now().microsecond}_' + \
-            os.path.basename(os.path.normpath(abs_path)) + '.gz'
-        z_path = os.path.join(gettempdir(), file_name)
-        with File_Thread_Locker(abs_path), open(z_path, 'wb+') as zip_file:
-            byte_count = 0
-            byte_chunk = min(self.__conf['ram'], byte_total)
-            skip_cache = b''
-            while byte_count < byte_total:
-                if byte_chunk != -1:
-                    data = self.__conn.recv(byte_chunk)
-                else:
-                    data = self.__conn.recv()
-                if b'!!SKIP!!SKIP!!' in skip_cache+data:
-                    raise SkipResponseException()
-                zip_file.write(data)
-                byte_count += len(data)
-                skip_cache = data[-14:]
-        with gzip.open(z_path, 'rb+') as zip_file:
-            with File_Thread_Locker(abs_path), open(abs_path, 'wb+') as file:
-                shutil.copyfileobj(zip_file, file)
+            command (str): Batched command name.
+            batch (list): List of json serializable command arguments.
 
-    def __send_directories(self, dirs):
+        Raises:
+            MissSpeakException: Raises if client fails to acknowledge the
+            batch.
+        """
+        payload = dump_json(batch)
+        compressed = 0
+        if self.__conf['compression'] and len(payload) >= self.__conf['compression_min']:
+            payload = compress(payload, self.__conf['compression'])
+            compressed = 1
+        cmd = f'BATCH {command} {len(payload)} {compressed}'.encode()
+        send_msg(self.__conn, cmd)
+        data = self.__recv(cmd)
+        if data != b'OK ' + cmd:
+            self.__logger.log(f'Send batch {command} ACK error', 1)
+            raise MissSpeakException(f'BATCH {command}')
+        self.__conn.sendall(payload)
+        data = recv_msg(self.__reader)
+        if data != b'OK':
+            self.__logger.log(f'Send batch {command} final ACK error', 1)
+            raise MissSpeakException(f'BATCH {command} FINAL')
+
+    def __send_files(self, up_files):
         """
-        Commands the client to create directories.
+        Sends files to remote client. Files are sent back to back and up to
+        PIPELINE_DEPTH final acknowledgments may be outstanding at once, so a
+        round trip is not spent per file.
 
         Args:
-            dirs (list): List of directories to remotely create.
+            up_files (list): List of paths of files to send.
 
         Raises:
-            MissSpeakException: Raises if client fails to create directory.
+            MissSpeakException: Raises if client does not acknowledge receiving
+            of file.
         """
-        error_count = 0
-        for _dir in dirs:
-            try:
-                self.__send_directory(_dir)
-                error_count = 0
-            except MissSpeakException as error:
-                error_count += 1
-                self.__logger.log('Send directory error', 1)
-                if error_count >= 5:
-                    raise error
-            except SkipResponseException:
-                self.__logger.log('Client requested to directory creation.', 4)
-
-    def __send_directory(self, _dir):
-        abs_path = _dir.replace('.', self.__root, 1)
-        cmd = f"MKDIR {_dir} {self.__server_struct[abs_path]['last_mod']}"
-        self.__conn.sendall(cmd.encode())
-        self.__logger.log(f'Sending directory {_dir}...', 4)
-
-        data = self.__recv(1024, cmd.encode())
-        if data != ('OK ' + cmd).encode():
-            self.__logger.log('Send directory error', 1)
-            raise MissSpeakException('MKDIR MissMatch')
+        unacked = deque()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            prepared = self.__compress_ahead(executor, up_files, 0)
+            for index, path in enumerate(up_files):
+                current = prepared
+                prepared = self.__compress_ahead(executor, up_files, index + 1)
+                try:
+                    if self.__send_file(path, current):
+                        unacked.append(path)
+                except SkipResponseException:
+                    pass
+                self.__collect_acks(unacked, PIPELINE_DEPTH - 1)
+        self.__collect_acks(unacked)
 
-    def __send_files(self, up_files):
+    def __collect_acks(self, unacked, keep=0):
         """
-        Sends files to remote client.
+        Reads final acknowledgments of sent files, oldest first, until at most
+        keep remain outstanding.
 
         Args:
-            up_files (list): List of paths of files to send.
+            unacked (deque): Paths of sent files awaiting acknowledgment.
+            keep (int, optional): Number of acknowledgments that may remain
+            outstanding. Defaults to 0.
 
         Raises:
-            MissSpeakException: Raises if client does not acknowledge the
-            request.
             MissSpeakException: Raises if client does not acknowledge receiving
             of file.
         """
-        error_count = 0
-        for path in up_files:
-            try:
-                self.__send_file(path)
-                error_count = 0
-            except MissSpeakException as error:
-                error_count += 1
-                if error_count >= 5:
-                    raise error
-            except SkipResponseException:
-                self.__logger.log('Client requested to skip receiving file.', 4)
-
-    def __send_file(self, path):
-        abs_path = path.replace('.', self.__root, 1)
-        info = self.__server_struct[abs_path]
+        while len(unacked) > keep:
+            path = unacked.popleft()
+            data = recv_msg(self.__reader)
+            if data == SKIP_SIGNAL:
+                self.__logger.log(f'Client requested to skip receiving file {path}.', 4)
+            elif data != b'OK':
+                self.__logger.log('Send file final ACK error', 1)
+                raise MissSpeakException('MKFILE ACK FINAL')
+
+    def __compress_ahead(self, executor, paths, index):
+        """
+        Starts compressing a file in the background so it overlaps with
+        sending the previous file. Only files small enough to be kept in
+        memory are compressed ahead, and only if the previous file's payload
+        and this one fit within the keep limit together, so the prefetch does
+        not double the memory used. Other files are compressed or streamed
+        when sent.
+
+        Args:
+            executor (ThreadPoolExecutor): Executor to compress with.
+            paths (list): List of paths of files to send.
+            index (int): Index of the file to compress.
+
+        Returns:
+            Future: Pending result of __compress_file or None if the file
+            is not compressed ahead.
+        """
+        if index >= len(paths) or not self.__kept_in_memory(paths[index]):
+            return None
+        path = paths[index]
+        held = 0
+        if index > 0 and self.__kept_in_memory(paths[index - 1]):
+            held = self.__server_struct[paths[index - 1]]['size']
+        if held + self.__server_struct[path]['size'] > keep_limit(self.__conf):
+            return None
+        return executor.submit(self.__compress_file, join_root(self.__root, path))
+
+    def __kept_in_memory(self, path):
+        """
+        Checks whether a file is sent compressed from memory.
+
+        Args:
+            path (str): Relative path of file to send.
+
+        Returns:
+            bool: Whether the file is compressed in memory.
+        """
+        size = self.__server_struct[path]['size']
+        return bool(self.__conf['compression']) and size >= self.__conf['compression_min'] \
+            and keep_compressed(size, self.__conf)
+
+    def __compress_file(self, abs_path):
+        """
+        Compresses a local file while holding its thread lock.
+
+        Args:
+            abs_path (str): Absolute path of file to be compressed.
+
+        Returns:
+            bytes: Compressed data.
+        """
+        with File_Thread_Locker(abs_path):
+            return compress_file(abs_path, self.__conf)
+
+    def __send_file(self, path, prepared=None):
+        """
+        Sends a single file to remote client without waiting for its
+        acknowledgment.
+
+        Args:
+            path (str): Relative path of file to send.
+            prepared (Future, optional): Pending result of
+            __compress_file if the file was compressed ahead. Defaults to
+            None, compressing the file now if it is kept in memory.
+
+        Raises:
+            SkipResponseException: Raises if the file could not be read.
+            MissSpeakException: Raises if an uncompressed file fails after
+            its size was announced, which cannot be signalled in band.
+
+        Returns:
+            bool: Whether the file was sent and an acknowledgment is due.
+        """
+        abs_path = join_root(self.__root, path)
+        info = self.__server_struct[path].to_dict()
         info['path'] = path
-        byte_total = os.path.getsize(abs_path)
-        compressed = False
-        if self.__conf['compression'] and byte_total >= self.__conf['compression_min']:
+        byte_total = info['size']
+        compressed = self.__conf['compression'] and byte_total >= self.__conf['compression_min']
+        payload = None
+        if compressed and self.__kept_in_memory(path):
             try:
-                byte_total, abs_path = self.__compress(abs_path)
-            except PermissionError:
-                return
-            compressed = True
+                if prepared is not None:
+                    payload = prepared.result()
+                else:
+                    payload = self.__compress_file(abs_path)
+            except OSError:
+                self.__logger.log(
+                    'Error encountered sending file ' + path, 1)
+                return False
+            byte_total = len(payload)
+        elif compressed:
+            byte_total = CHUNKED
         info['bytes'] = byte_total
-        cmd = f"MKFILE {json.dumps(info)}"
-        self.__conn.sendall(cmd.encode())
-
-        data = self.__recv(1024, cmd.encode())
-        client_ack = f"OK MKFILE {path} {byte_total}"
-        if data == client_ack.encode():
-            self.__logger.log(f'Sending file {path} {byte_total}...', 4)
-            if byte_total > 0:
-                bytes_read = 0
-                byte_chunk = min(self.__conf['ram'], byte_total)
-                try:
-                    with File_Thread_Locker(abs_path), open(abs_path, 'rb') as f:
-                        while bytes_read < byte_total:
-                            if byte_chunk != -1:
-                                file_bytes = f.read(byte_chunk)
-                            else:
-                                file_bytes = f.read()
-                            self.__conn.sendall(file_bytes)
-                            bytes_read += len(file_bytes)
-                except PermissionError:
-                    self.__logger.log(
-                        'Permssion error encountered sending file' + path, 1)
-                    self.__conn.sendall(b'!!SKIP!!SKIP!!')
-                    raise SkipResponseException()
-                except FileNotFoundError:
-                    self.__conn.sendall(b'!!SKIP!!SKIP!!')
-                    raise SkipResponseException()
-                if compressed:
-                    try:
-                        os.remove(abs_path)
-                    except PermissionError:
-                        self.__logger.log('Unable to delete compressed file.', 1)
-                    except FileNotFoundError:
-                        pass
-            data = self.__conn.recv(1024)
-            if data != b'OK':
-                self.__logger.log('Send file final ACK error', 1)
-                raise MissSpeakException('MKFILE ACK FINAL')
-            elif data == b'!!SKIP!!SKIP!!':
-                raise SkipResponseException()
-        else:
-            self.__logger.log('Send file ACK error', 1)
-            raise MissSpeakException('MKFILE ACK')
+        cmd = b'MKFILE ' + dump_json(info)
+        header_sent = False
+        self.__logger.log(f'Sending file {path} {byte_total}...', 4)
+        try:
+            if payload is not None:
+                self.__conn.sendall(frame(cmd) + payload)
+            else:
+                with File_Thread_Locker(abs_path), open(abs_path, 'rb') as f:
+                    if compressed:
+                        send_msg(self.__conn, cmd)
+                        header_sent = True
+                        send_compressed(self.__conn, self.__writer, f, self.__conf)
+                    else:
+                        head = f.read(min(HEAD_CHUNK, byte_total))
+                        self.__conn.sendall(frame(cmd) + head)
+                        header_sent = True
+                        if send_uncompressed(self.__conn, f, len(head), byte_total):
+                            self.__logger.log(f'File {path} changed while sending data. '
+                                                + 'Sent zero padded.', 1)
+        except (PermissionError, FileNotFoundError):
+            self.__logger.log(
+                'Error encountered sending file ' + path, 1)
+            if header_sent:
+                if not compressed:
+                    raise MissSpeakException('SEND File')
+                self.__conn.sendall(SKIP_FRAME)
+            raise SkipResponseException()
+        return True
 
     def __handle_deletes(self, deletes):
         """
@@ -508,62 +661,77 @@ class ServerThread(Thread):
 
     def __down_deletes(self, down_dirs, down_files):
         """
-        Deletes local file structure objects.
+        Deletes local file structure objects. Directories nested in another
+        deleted directory, and files within a removed directory, go with it
+        and are neither confirmed nor deleted separately.
 
         Args:
             down_dirs (list): List of directories to delete.
             down_files (list): List of files to delete.
         """
-        error_count = 0
-        for _dir in down_dirs:
-            try:
-                if self.__confirm_delete(_dir):
-                    self.__delete_dir(_dir)
-                    error_count = 0
-            except MissSpeakException as error:
-                error_count += 1
-                if error_count >= 5:
-                    raise error
-            except SkipResponseException:
-                self.__logger.log('Client requested to skip deletion.', 3)
-        error_count = 0
-        for file in down_files:
-            try:
-                if self.__confirm_delete(file):
-                    self.__delete_file(file)
-                    error_count = 0
-            except MissSpeakException as error:
-                error_count += 1
-                if error_count >= 5:
-                    raise error
-            except SkipResponseException:
-                self.__logger.log('Client requested to skip deletion.', 3)
+        try:
+            confirmed = self.__confirm_deletes(down_dirs)
+            removed = {_dir for _dir in self.__outside(confirmed, set(confirmed))
+                        if self.__delete_dir(_dir)}
+            for file in self.__confirm_deletes(self.__outside(down_files, removed)):
+                self.__delete_file(file)
+        except SkipResponseException:
+            self.__logger.log('Client requested to skip deletion.', 3)
 
-    def __confirm_delete(self, path):
+    def __confirm_deletes(self, paths):
         """
-        Confirms with Client file structure object is still marked for deletion.
+        Confirms with Client which file structure objects are still marked for
+        deletion. Paths are confirmed in batches of CONFIRM_BATCH_SIZE with one
+        round trip per batch.
 
         Args:
-            path (str): Path to delete.
+            paths (list): Paths to delete.
 
         Raises:
-            MissSpeakException: Client is unable to confirm or deny deletion.
+            MissSpeakException: Client is unable to confirm or deny deletions.
 
         Returns:
-            bool: Whether allowed to delete path.
-        """
-        req = f'CONFIRM DELETE {path}'.encode()
-        self.__conn.sendall(req)
-        data = self.__recv(1024, req)
-        if data == f'OK {path}'.encode():
-            self.__logger.log(f'Delete {path} confirmed.', 3)
-            return True
-        elif data == f'NO {path}'.encode():
-            self.__logger.log(f'Delete {path} denied.', 3)
-            return False
-        else:
-            self.__logger.log('Confirm delete error', 1)
-            raise MissSpeakException('CONFIRM DELETE')
+            list: Paths allowed to be deleted.
+        """
+        confirmed = []
+        for start in range(0, len(paths), CONFIRM_BATCH_SIZE):
+            batch = paths[start:start + CONFIRM_BATCH_SIZE]
+            req = b'CONFIRM DELETES ' + dump_json(batch)
+            send_msg(self.__conn, req)
+            decisions = load_json(self.__recv(req))
+            if not isinstance(decisions, list) or len(decisions) != len(batch):
+                self.__logger.log('Confirm delete error', 1)
+                raise MissSpeakException('CONFIRM DELETES')
+            for path, allowed in zip(batch, decisions):
+                if allowed:
+                    self.__logger.log(f'Delete {path} confirmed.', 3)
+                    confirmed.append(path)
+                else:
+                    self.__logger.log(f'Delete {path} denied.', 3)
+        return confirmed
+
+    def __outside(self, paths, dirs):
+        """
+        Filters out paths that lie within any of the given directories.
+
+        Args:
+            paths (list): Relative paths.
+            dirs (set): Relative paths of directories.
+
+        Returns:
+            list: Paths not within any of the directories.
+        """
+        if not dirs:
+            return paths
+        dirname = os.path.dirname
+        kept = []
+        for path in paths:
+            parent = dirname(path)
+            while parent not in dirs and len(parent) > 1:
+                parent = dirname(parent)
+            if parent not in dirs:
+                kept.append(path)
+        return kept
 
     def __delete_dir(self, _dir):
         """
@@ -571,19 +739,24 @@ class ServerThread(Thread):
 
         Args:
             _dir (str): Relative path of directory
+
+        Returns:
+            bool: Whether the directory is gone.
         """
-        abs_file = _dir.replace('.', self.__root, 1)
+        abs_file = join_root(self.__root, _dir)
         try:
             if not self.__conf['backup']:
                 shutil.rmtree(abs_file)
             else:
-                backup_path = _dir.replace('.', self.__conf['backup_path'], 1)
+                backup_path = join_root(self.__conf['backup_path'], _dir)
                 shutil.move(abs_file, backup_path)
         except FileNotFoundError:
             pass
         except PermissionError:
             self.__logger.log('Permission error encountered deleting ' 
                                 + _dir, 1)
+            return False
+        return True
 
     def __delete_file(self, file):
         """
@@ -592,12 +765,12 @@ class ServerThread(Thread):
         Args:
             file (str): Relative path of file
         """
-        abs_file = file.replace('.', self.__root, 1)
+        abs_file = join_root(self.__root, file)
         try:
             if not self.__conf['backup']:
                 os.remove(abs_file)
             else:
-                backup_path = file.replace('.', self.__conf['backup_path'], 1)
+                backup_path = join_root(self.__conf['backup_path'], file)
                 shutil.move(abs_file, backup_path)
         except FileNotFoundError:
             pass
@@ -607,7 +780,9 @@ class ServerThread(Thread):
 
     def __up_deletes(self, up_dirs, up_files):
         """
-        Sends delete commands to client.
+        Sends delete commands to client in a single batch. Paths within a
+        directory being deleted are left out, since the client removes them
+        along with it.
 
         Args:
             up_dirs (list): List of directories to delete.
@@ -617,103 +792,61 @@ class ServerThread(Thread):
             MissSpeakException: Raises if client cannot acknowledge deletion
             request
         """
-        deletes = up_dirs + up_files
-        
-        error_count = 0
+        root = self.__root
+        exists = os.path.exists
+        dirs = [path for path in up_dirs if not exists(root + path[1:])]
+        removed = set(dirs)
+        deletes = self.__outside(dirs, removed)
+        deletes.extend(path for path in self.__outside(up_files, removed)
+                        if not exists(root + path[1:]))
         for path in deletes:
-            try:
-                self.__send_delete_cmd(path)
-                error_count = 0
-            except MissSpeakException as error:
-                error_count += 1
-                if error_count >= 5:
-                    raise error
-
-    def __send_delete_cmd(self, path):
-        """
-        Sends delete command to client
-
-        Args:
-            path (str): Relative path to remotely delete.
-
-        Raises:
-            MissSpeakException: Raises if client cannot acknowledge deletion
-            request
-        """
-        abs_path = path.replace('.', self.__root, 1)
-        if not os.path.exists(abs_path):
-            cmd = f'DELETE {path}'
-            self.__conn.sendall(cmd.encode())
-            self.__logger.log(f'Sending {cmd}', 3)
-
-            data = self.__recv(1024, cmd.encode())
-            if data != b'OK':
-                self.__logger.log('Send deletion error', 1)
-                raise MissSpeakException('DELETE')
+            self.__logger.log(f'Sending DELETE {path}', 3)
+        if len(deletes) == 0:
+            return
+        try:
+            self.__send_batch('DELETE', deletes)
+        except SkipResponseException:
+            self.__logger.log('Client requested to skip deletion.', 3)
 
     def __purge_backups(self):
         """
-        Removes old backups
-        """
-        self.__logger.log('Cleaning backups...', 2)
-        day_limit = self.__conf['backup_limit']
-        now_time = datetime.now()
-        for _, dirs, files in os.walk(self.__conf['backup_path'], topdown=True):
-            for _dir in dirs:
-                status = os.stat(_dir)
-                last_mod = datetime.fromtimestamp(status[stat.ST_MTIME])
-                delta = now_time - last_mod
-                if delta.days >= day_limit:
-                    shutil.rmtree(_dir)
-            for file in files:
-                status = os.stat(file)
-                last_mod = datetime.fromtimestamp(status[stat.ST_MTIME])
-                delta = now_time - last_mod
-                if delta.days >= day_limit:
-                    os.remove(file)
-        self.__logger.log('Backups cleaned...', 2)
-
-    def __compress(self, path):
-        """
-        Compresses file using gzip.
-
-        Args:
-            path (str): Path of file to be compressed.
+        Removes old backups. Backup directories are shared by every
+        connection, so a directory is only scanned if no other thread is
+        purging it and it has not been purged within PURGE_INTERVAL seconds.
+        """
+        backup_path = self.__conf['backup_path']
+        now = time.time()
+        if not purge_lock.acquire(blocking=False):
+            return
+        try:
+            if now - last_purge.get(backup_path, 0) < PURGE_INTERVAL:
+                return
+            self.__logger.log('Cleaning backups...', 2)
+            purge_directory(backup_path,
+                            now - self.__conf['backup_limit'] * 86400)
+            last_purge[backup_path] = now
+            self.__logger.log('Backups cleaned...', 2)
+        finally:
+            purge_lock.release()
 
-        Returns:
-            Tuple(int, str): Size of compressed file and compressed file path.
-        """
-        file_name = f'{datetime.now().microsecond}_' + \
-            os.path.basename(os.path.normpath(path)) + '.gz'
-        temp_path = os.path.join(gettempdir(), 'pysync')
-        os.makedirs(temp_path, exist_ok=True)
-        with File_Thread_Locker(path), open(path, 'rb') as f_in:
-            z_path = os.path.join(temp_path, file_name)
-            with gzip.open(z_path, 'wb', 
-                            compresslevel=self.__conf['compression']) as f_out:
-                shutil.copyfileobj(f_in, f_out)
-        return os.path.getsize(z_path), z_path
-    
-    def __recv(self, b, prev_cmd):
+    def __recv(self, prev_cmd):
         """
         Waits for client response and resends previous command if RETRY code is
         received.
 
         Args:
-            b (int): Number of bytes expected to be received.
-            prev_cmd (str): Previously sent command.
+            prev_cmd (bytes): Previously sent command.
 
         Returns:
             bytes: Data received from client.
         """
-        data = self.__conn.recv(b)
-        if data == b'RETRY':
-            self.__conn.sendall(prev_cmd)
-            return self.__recv(b, prev_cmd)
-        elif data == b'!!SKIP!!SKIP!!':
+        data = recv_msg(self.__reader)
+        while data == b'RETRY':
+            send_msg(self.__conn, prev_cmd)
+            data = recv_msg(self.__reader)
+        if data == SKIP_SIGNAL:
             raise SkipResponseException()
-        else:
-            return data
+        return data
         
     def __timeshift_dirs(self):
         """
@@ -724,11 +857,10 @@ class ServerThread(Thread):
 
     def terminate(self):
         """
-        Terminates thread slightly more gracefully.
+        Shuts down the client connection, so a running sync stops at its next
+        read or write and closes the connection itself.
         """
         try:
             self.__conn.shutdown(socket.SHUT_RDWR)
-            self.__conn.close()
-        except:
+        except OSError:
             pass
-        super.terminate()
@@ -6,33 +6,16 @@ class Structure_Comparer:
 
     def __init__(self, structure1, structure2):
         """
-        Initializes comparer with strutures.
+        Initializes comparer with strutures. The structures are only read, so
+        shared or read only mappings can be passed without copying.
 
         Args:
-            structure1 (dict): File structure dictionary one.
-            structure2 (dict): File structure dictionary two.
+            structure1 (Mapping): File structure dictionary one.
+            structure2 (Mapping): File structure dictionary two.
         """
-        self.__root1 = structure1.pop('root')
-        self.__structure1 = self.__purge_roots(structure1, self.__root1)
+        self.__structure1 = structure1
         self.__structure2 = structure2
-
-    def __purge_roots(self, structure, root):
-        """
-        Removes absolute paths from the structure dictionaries and makes them
-        relative to a base parent.
-
-        Args:
-            structure (dict): File structure dictionary.
-            root (str): Root of the structure.
-
-        Returns:
-            dict: Purged file structure dictionary.
-        """
-        new_structure = {}
-        for path in structure.keys():
-            _path = path.replace(root, '.', 1)
-            new_structure[_path] = structure[path]
-        return new_structure
+        self.__created = set()
 
     def compare_structures(self, purge):
         """
@@ -63,12 +46,8 @@ class Structure_Comparer:
         """
         create_2, remove_1 = self.__create_filter(self.__structure1, self.__structure2)
         create_1, remove_2 = self.__create_filter(self.__structure2, self.__structure1)
-
-        for path in remove_1:
-            self.__structure1.pop(path)
-        for path in remove_2:
-            self.__structure2.pop(path)
-        
+        self.__created = set(remove_1)
+        self.__created.update(remove_2)
         return create_1, create_2
 
     def __create_filter(self, structure1, structure2):
@@ -112,7 +91,8 @@ class Structure_Comparer:
 
     def __filter_deletes(self, structure1, structure2):
         """
-        Filter for deletions in two file structures.
+        Filter for deletions in two file structures. Paths already being
+        created are ignored.
 
         Args:
             structure1 (dict): File structure dictionary.
@@ -123,8 +103,10 @@ class Structure_Comparer:
         """
         dirs_2 = []
         files_2 = []
+        created = self.__created
         for path, info_1 in structure1.items():
-            if info_1['deleted'] is not None and path in structure2:
+            if info_1['deleted'] is not None and path in structure2 \
+                    and path not in created:
                 info_2 = structure2[path]
                 if info_2['deleted'] is None and info_1['last_mod'] > info_2['last_mod']:
                     if info_1['type'] == 0:
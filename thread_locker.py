@@ -15,23 +15,25 @@ class File_Thread_Locker:
             abspath (str): Absolute path of file being interacted with.
         """
         self.__abspath = abspath
+        self.__lock = None
         
     def __enter__(self):
         """
-        Acquires lock from global thread locker dictionary and indicates use.
+        Acquires lock from global thread locker dictionary. The locker holds
+        the only strong reference keeping the lock alive, so the dictionary
+        entry disappears once no thread is using the path.
         """
-        if self.__abspath in server.thread_locks:
-            server.thread_locks[self.__abspath][0] += 1
-            server.thread_locks[self.__abspath][1].acquire(timeout=60)
-        else:
-            server.thread_locks[self.__abspath] = [1, Lock()]
-            server.thread_locks[self.__abspath][1].acquire()
+        with server.thread_locks_guard:
+            lock = server.thread_locks.get(self.__abspath)
+            if lock is None:
+                lock = Lock()
+                server.thread_locks[self.__abspath] = lock
+        self.__lock = lock
+        lock.acquire(timeout=60)
         
     def __exit__(self, exc_type, exc_value, trace):
         """
-        Releases lock from global thread locker and marks as not in use.
+        Releases lock from global thread locker.
         """
-        status = server.thread_locks[self.__abspath]
-        status[1].release()
-        status[0] -= 1
-        server.thread_locks[self.__abspath] = status
+        self.__lock.release()
+        self.__lock = None
@@ -0,0 +1,514 @@
+import os
+import io
+import mmap
+import shutil
+import ssl
+from concurrent.futures import wait
+from exceptions import MissSpeakException, SkipResponseException
+from framing import CHUNKED, END_FRAME, frame, recv_into, recv_chunk_size
+from compression import gzip_compressor, gzip_decompressor
+
+RECV_CHUNK = 1 << 20
+SEND_CHUNK = 1 << 20
+KEEP_COMPRESSED = 1 << 20
+MAX_KEEP_COMPRESSED = 64 << 20
+ZERO_CHUNK = bytes(SEND_CHUNK)
+
+
+def chunk_size(conf):
+    """
+    Gets the size of the chunks files are received and read in. RECV_CHUNK
+    is capped at half the ram limit so a double buffered receive stays
+    within it.
+
+    Args:
+        conf (dict): Configuration dictionary.
+
+    Returns:
+        int: Chunk size in bytes.
+    """
+    size = RECV_CHUNK
+    if conf['ram'] != -1:
+        size = min(size, conf['ram'] // 2)
+    return size
+
+
+def recv_buffers(pool, size, count):
+    """
+    Gets reusable receive buffers. Buffers are kept between files and only
+    reallocated when a larger one is needed.
+
+    Args:
+        pool (list(bytearray)): Buffers kept by the connection. Updated in
+        place.
+        size (int): Minimum size of each buffer.
+        count (int): Number of buffers needed.
+
+    Returns:
+        list(bytearray): Receive buffers.
+    """
+    for index in range(count):
+        if index == len(pool):
+            pool.append(bytearray(size))
+        elif len(pool[index]) < size:
+            pool[index] = bytearray(size)
+    return pool[:count]
+
+
+def recv_into_file(reader, writer, file, byte_total, conf, pool,
+                    decompressor=None):
+    """
+    Receives bytes from the connection and writes them to an open file.
+    Large files are double buffered: while one buffer is written out by the
+    writer thread, the next is received into the other, so the network and
+    the disk are kept busy at the same time. If a write fails the rest of
+    the file is still received, and discarded, before the error is raised,
+    so the connection stays in step.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+        writer (ThreadPoolExecutor): Single worker executor writing chunks.
+        file (file): File opened for binary writing.
+        byte_total (int): Total bytes expected to be received.
+        conf (dict): Configuration dictionary.
+        pool (list(bytearray)): Receive buffers kept by the connection.
+        decompressor (Decompress, optional): zlib decompressor applied to
+        the received bytes before writing. Defaults to None.
+
+    Raises:
+        MissSpeakException: Raised if the connection closes early.
+    """
+    size = min(chunk_size(conf), byte_total)
+    buffers = recv_buffers(pool, size, 1 if size == byte_total else 2)
+    pending = [None] * len(buffers)
+    error = None
+    index = 0
+    byte_count = 0
+    readinto1 = reader.readinto1
+    try:
+        while byte_count < byte_total:
+            if pending[index] is not None:
+                error = error or pending[index].exception()
+                pending[index] = None
+            view = memoryview(buffers[index])
+            fill = min(size, byte_total - byte_count)
+            filled = 0
+            while filled < fill:
+                received = readinto1(view[filled:fill])
+                if received == 0:
+                    raise MissSpeakException('RECV File')
+                filled += received
+            byte_count += fill
+            if error is not None:
+                continue
+            if len(buffers) == 1:
+                try:
+                    write_chunk(file, view[:fill], decompressor)
+                except Exception as exc:
+                    error = exc
+            else:
+                pending[index] = writer.submit(
+                    write_chunk, file, view[:fill], decompressor)
+                index = 1 - index
+    finally:
+        wait([future for future in pending if future is not None])
+    for future in pending:
+        if future is not None:
+            error = error or future.exception()
+    if error is not None:
+        raise error
+    if decompressor is not None:
+        file.write(decompressor.flush())
+
+
+def recv_chunked(reader, writer, file, pool, decompressor):
+    """
+    Receives a compressed stream sent as length prefixed chunks, ending
+    with an empty chunk, and writes it to an open file. Chunks alternate
+    between two buffers so the writer thread decompresses and writes one
+    while the next is received. If a write fails the rest of the stream is
+    still received, and discarded, before the error is raised.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+        writer (ThreadPoolExecutor): Single worker executor writing chunks.
+        file (file): File opened for binary writing.
+        pool (list(bytearray)): Receive buffers kept by the connection.
+        decompressor (Decompress): zlib decompressor applied to the
+        received bytes before writing.
+
+    Raises:
+        SkipResponseException: Raised if the sender aborts the stream.
+        MissSpeakException: Raised if a chunk is too large or the
+        connection closes early.
+    """
+    buffers = recv_buffers(pool, SEND_CHUNK, 2)
+    pending = [None, None]
+    error = None
+    index = 0
+    try:
+        size = recv_chunk_size(reader)
+        while size:
+            if size > SEND_CHUNK:
+                raise MissSpeakException('RECV Chunk')
+            if pending[index] is not None:
+                error = error or pending[index].exception()
+                pending[index] = None
+            view = memoryview(buffers[index])[:size]
+            recv_into(reader, view)
+            if error is None:
+                pending[index] = writer.submit(write_chunk, file, view, decompressor)
+                index = 1 - index
+            size = recv_chunk_size(reader)
+    finally:
+        wait([future for future in pending if future is not None])
+    for future in pending:
+        if future is not None:
+            error = error or future.exception()
+    if error is not None:
+        raise error
+    file.write(decompressor.flush())
+
+
+def recv_file(reader, writer, abs_path, byte_total, conf, pool,
+                compressed=False):
+    """
+    Receives a file's payload and writes it to a local path. If the file
+    cannot be opened the payload is received and discarded before the error
+    is raised, so the connection stays in step.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+        writer (ThreadPoolExecutor): Single worker executor writing chunks.
+        abs_path (str): Absolute path to place the received file.
+        byte_total (int): Total bytes expected to be received, or CHUNKED if
+        a compressed stream is sent in chunks.
+        conf (dict): Configuration dictionary.
+        pool (list(bytearray)): Receive buffers kept by the connection.
+        compressed (bool, optional): Whether the payload is gzip compressed.
+        Defaults to False.
+
+    Raises:
+        OSError: Raised if the file could not be opened or written.
+        SkipResponseException: Raised if the sender aborts a chunked stream.
+        MissSpeakException: Raised if the connection closes early.
+    """
+    try:
+        file = open(abs_path, 'wb+')
+    except OSError:
+        discard_payload(reader, byte_total, pool)
+        raise
+    with file:
+        if not compressed:
+            recv_into_file(reader, writer, file, byte_total, conf, pool)
+        elif byte_total == CHUNKED:
+            recv_chunked(reader, writer, file, pool, gzip_decompressor())
+        else:
+            recv_into_file(reader, writer, file, byte_total, conf, pool,
+                            gzip_decompressor())
+
+
+def discard_payload(reader, byte_total, pool):
+    """
+    Receives a file's payload without keeping it.
+
+    Args:
+        reader (BufferedReader): Buffered reader over the connection.
+        byte_total (int): Total bytes expected to be received, or CHUNKED if
+        the payload is sent in chunks.
+        pool (list(bytearray)): Receive buffers kept by the connection.
+
+    Raises:
+        MissSpeakException: Raised if a chunk is too large or the
+        connection closes early.
+    """
+    if byte_total == CHUNKED:
+        view = memoryview(recv_buffers(pool, SEND_CHUNK, 1)[0])
+        try:
+            size = recv_chunk_size(reader)
+            while size:
+                if size > SEND_CHUNK:
+                    raise MissSpeakException('RECV Chunk')
+                recv_into(reader, view[:size])
+                size = recv_chunk_size(reader)
+        except SkipResponseException:
+            pass
+        return
+    view = memoryview(recv_buffers(pool, min(RECV_CHUNK, byte_total), 1)[0])
+    while byte_total > 0:
+        fill = min(len(view), byte_total)
+        recv_into(reader, view[:fill])
+        byte_total -= fill
+
+
+def write_chunk(file, data, decompressor=None):
+    """
+    Writes a received chunk to an open file, decompressing it first in
+    pieces of at most RECV_CHUNK bytes if a decompressor is given.
+
+    Args:
+        file (file): File opened for binary writing.
+        data (memoryview): Bytes received.
+        decompressor (Decompress, optional): zlib decompressor applied to
+        the received bytes before writing. Defaults to None.
+    """
+    if decompressor is None:
+        file.write(data)
+        return
+    output = decompressor.decompress(data, RECV_CHUNK)
+    while output:
+        file.write(output)
+        output = decompressor.decompress(decompressor.unconsumed_tail, RECV_CHUNK)
+
+
+def read_chunks(file, conf):
+    """
+    Reads an open file in chunks into a single reusable buffer. The buffer
+    is sized to the file when it is smaller than a chunk, so small files do
+    not pay for allocating and zeroing a full chunk.
+
+    Args:
+        file (file): File opened for binary reading.
+        conf (dict): Configuration dictionary.
+
+    Yields:
+        memoryview: Bytes read, valid until the next chunk is read.
+    """
+    size = max(os.fstat(file.fileno()).st_size, io.DEFAULT_BUFFER_SIZE)
+    buffer = bytearray(min(chunk_size(conf), size))
+    view = memoryview(buffer)
+    readinto = file.readinto
+    received = readinto(buffer)
+    while received:
+        yield view[:received]
+        received = readinto(buffer)
+
+
+def send_uncompressed(conn, file, offset, byte_total):
+    """
+    Sends the rest of an uncompressed file. Plain connections use sendfile
+    so the data never enters user space; TLS connections send from a memory
+    map. If the file shrank since its size was announced, the stream is
+    zero padded to byte_total so the connection stays in step.
+
+    Args:
+        conn (Socket): Connected socket.
+        file (file): File opened for binary reading.
+        offset (int): Bytes of the file already sent.
+        byte_total (int): Size announced to the receiver.
+
+    Returns:
+        bool: Whether the file shrank and was padded.
+    """
+    if offset < byte_total:
+        if not isinstance(conn, ssl.SSLSocket):
+            offset += conn.sendfile(file, offset, byte_total - offset)
+        else:
+            offset = send_mapped(conn, file, offset, byte_total)
+    if offset >= byte_total:
+        return False
+    send_padding(conn, byte_total - offset)
+    return True
+
+
+def send_padding(conn, byte_total):
+    """
+    Sends zero bytes in slices of one shared SEND_CHUNK buffer, so padding
+    never allocates the whole shortfall.
+
+    Args:
+        conn (Socket): Connected socket.
+        byte_total (int): Number of zero bytes to send.
+    """
+    view = memoryview(ZERO_CHUNK)
+    while byte_total > 0:
+        size = min(SEND_CHUNK, byte_total)
+        conn.sendall(view[:size])
+        byte_total -= size
+
+
+def send_mapped(conn, file, offset, byte_total):
+    """
+    Sends part of a file straight from a read only memory map, avoiding a
+    read copy per chunk. Used where sendfile is unavailable, such as over
+    TLS.
+
+    Args:
+        conn (Socket): Connected socket.
+        file (file): File opened for binary reading.
+        offset (int): Offset of the first byte to send.
+        byte_total (int): Offset to stop sending at.
+
+    Returns:
+        int: Offset reached, which falls short of byte_total if the file
+        shrank.
+    """
+    try:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except ValueError:
+        return offset
+    with mapped:
+        view = memoryview(mapped)
+        sendall = conn.sendall
+        try:
+            byte_total = min(byte_total, len(mapped))
+            while offset < byte_total:
+                end = min(offset + SEND_CHUNK, byte_total)
+                sendall(view[offset:end])
+                offset = end
+        finally:
+            view.release()
+    return offset
+
+
+def keep_limit(conf):
+    """
+    Gets the size up to which files are compressed in memory: the larger of
+    KEEP_COMPRESSED and the ram limit, but never more than
+    MAX_KEEP_COMPRESSED, even with unlimited ram.
+
+    Args:
+        conf (dict): Configuration dictionary.
+
+    Returns:
+        int: Largest file size compressed in memory, in bytes.
+    """
+    ram = conf['ram']
+    if ram == -1:
+        return MAX_KEEP_COMPRESSED
+    return min(max(KEEP_COMPRESSED, ram), MAX_KEEP_COMPRESSED)
+
+
+def keep_compressed(size, conf):
+    """
+    Checks whether a file is compressed in memory, so it can be sent in one
+    write with its size announced, rather than streamed in chunks. Deciding
+    from the file size up front means no file is compressed twice.
+
+    Args:
+        size (int): Size of the file in bytes.
+        conf (dict): Configuration dictionary.
+
+    Returns:
+        bool: Whether the file is compressed in memory.
+    """
+    return size <= keep_limit(conf)
+
+
+def compress_file(path, conf):
+    """
+    Compresses a file in memory.
+
+    Args:
+        path (str): Path of file to be compressed.
+        conf (dict): Configuration dictionary.
+
+    Returns:
+        bytes: Compressed data.
+    """
+    compressor = gzip_compressor(conf['compression'])
+    compress = compressor.compress
+    with open(path, 'rb') as file:
+        chunks = [compress(chunk) for chunk in read_chunks(file, conf)]
+    chunks.append(compressor.flush())
+    return b''.join(chunks)
+
+
+def send_compressed(conn, writer, file, conf):
+    """
+    Compresses an open file and streams it as it is read, as length
+    prefixed chunks of at most SEND_CHUNK bytes followed by an empty chunk,
+    so the compressed size never has to be known up front. Each chunk is
+    sent by the writer thread while the next one is compressed, so
+    compression and the network overlap.
+
+    Args:
+        conn (Socket): Connected socket.
+        writer (ThreadPoolExecutor): Single worker executor sending chunks.
+        file (file): File opened for binary reading.
+        conf (dict): Configuration dictionary.
+    """
+    compressor = gzip_compressor(conf['compression'])
+    compress = compressor.compress
+    submit = writer.submit
+    sendall = conn.sendall
+    pending = None
+    try:
+        for chunk in read_chunks(file, conf):
+            data = compress(chunk)
+            for start in range(0, len(data), SEND_CHUNK):
+                piece = frame(data[start:start + SEND_CHUNK])
+                if pending is not None:
+                    pending.result()
+                pending = submit(sendall, piece)
+    finally:
+        if pending is not None:
+            wait([pending])
+    if pending is not None:
+        pending.result()
+    data = compressor.flush()
+    sendall(b''.join(frame(data[start:start + SEND_CHUNK])
+                        for start in range(0, len(data), SEND_CHUNK)) + END_FRAME)
+
+
+def purge_directory(path, cutoff):
+    """
+    Removes backups last modified before the cutoff within a directory.
+    Directories that are too recent to remove are searched recursively.
+
+    Args:
+        path (str): Backup directory path.
+        cutoff (float): Timestamp before which backups are removed.
+    """
+    try:
+        with os.scandir(path) as scanner:
+            entries = list(scanner)
+    except OSError:
+        return
+    for entry in entries:
+        try:
+            is_dir = entry.is_dir(follow_symlinks=False)
+            if entry.stat(follow_symlinks=False).st_mtime > cutoff:
+                if is_dir:
+                    purge_directory(entry.path, cutoff)
+            elif is_dir:
+                shutil.rmtree(entry.path)
+            else:
+                os.remove(entry.path)
+        except OSError:
+            continue
+
+
+def make_directory(abs_path, created):
+    """
+    Creates a directory. When its parent was created earlier in the same
+    batch the ancestor checks of os.makedirs are skipped.
+
+    Args:
+        abs_path (str): Absolute path of directory to create.
+        created (set): Absolute paths of directories already created in
+        this batch. Updated in place.
+    """
+    if os.path.dirname(abs_path) in created:
+        try:
+            os.mkdir(abs_path)
+        except FileExistsError:
+            if not os.path.isdir(abs_path):
+                raise
+    else:
+        os.makedirs(abs_path, exist_ok=True)
+    created.add(abs_path)
+
+
+def join_root(root, path):
+    """
+    Converts a root relative path into an absolute path.
+
+    Args:
+        root (str): Root to resolve against.
+        path (str): Relative path starting with '.'.
+
+    Returns:
+        str: Absolute path.
+    """
+    return root + path[1:]